@@ -0,0 +1,254 @@
+"""
+Throughput and latency benchmark of the serial <-> TCP data path, on Linux.
+
+UARTs are pseudo terminals (see machine.py in this directory) and the
+serial devices are played by this script on the other end of the pty:
+
+* uart->tcp: the device sends *size* bytes in bursts, every client must
+  receive all of them
+* tcp->uart: the first client sends *size* bytes, the device receives them
+* rtt: an examples/ptyserver.py Echo device; a client sends lines of
+  *payload* bytes and waits for each echo
+
+Targets: us2n (poll engine), us2n-async (asyncio engine), s2n and s2n-fd
+(pyserial and Linux file descriptor engines, need pyserial). Results are printed (or written to --output) as JSON.
+
+Example::
+
+    $ python bench/bench.py --target us2n --size 4000000 --clients 2
+"""
+
+import os
+import sys
+import pty
+import tty
+import json
+import time
+import socket
+import logging
+import argparse
+import platform
+import threading
+import tracemalloc
+
+this_dir = os.path.dirname(os.path.abspath(__file__))
+root_dir = os.path.dirname(this_dir)
+sys.path[:0] = [this_dir, root_dir, os.path.join(root_dir, 'examples')]
+
+if not hasattr(sys, 'print_exception'):
+    import traceback
+    sys.print_exception = lambda e, file=sys.stderr: \
+        traceback.print_exception(e, file=file)
+
+import ptyserver
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def start_thread(target, *args):
+    thread = threading.Thread(target=target, args=args, daemon=True)
+    thread.start()
+    return thread
+
+
+def us2n_target(args, engine):
+    import us2n
+    us2n.VERBOSE = 0
+    config = dict(engine=engine, bridges=[dict(
+        tcp=dict(bind=['127.0.0.1', args.port], max_clients=args.clients,
+                 queue_size=args.queue_size),
+        uart=dict(port=1, baudrate=args.baudrate, chunk=args.chunk))])
+    if engine == 'asyncio':
+        import us2n_async
+        server = us2n_async.AsyncS2NServer(config)
+    else:
+        server = us2n.S2NServer(config)
+    start_thread(server._serve_forever)
+    while not server.bridges:
+        time.sleep(0.01)
+    uart = server.bridges[0].uart
+    return uart.device, server.get_stats
+
+
+def s2n_target(args, engine):
+    import s2n
+    device, fd = pty.openpty()
+    tty.setraw(device)
+    tty.setraw(fd)
+    opts = s2n.serial_options(dict(port=os.ttyname(fd),
+                                   baudrate=args.baudrate))
+    port = s2n.ENGINES[engine](('127.0.0.1', args.port), opts)
+    start_thread(s2n.serve, [port])
+    return device, lambda: port.stats
+
+
+TARGETS = {
+    'us2n': lambda args: us2n_target(args, 'poll'),
+    'us2n-async': lambda args: us2n_target(args, 'asyncio'),
+    's2n': lambda args: s2n_target(args, 'pyserial'),
+    's2n-fd': lambda args: s2n_target(args, 'fd'),
+}
+
+
+def connect(args, n):
+    clients = []
+    for _ in range(n):
+        for _ in range(100):
+            try:
+                client = socket.create_connection(('127.0.0.1', args.port))
+                break
+            except ConnectionRefusedError:
+                time.sleep(0.05)
+        client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        clients.append(client)
+    # let the server register them
+    time.sleep(0.2)
+    return clients
+
+
+def receive(sock, size, buf):
+    received = 0
+    while received < size:
+        n = sock.recv_into(buf)
+        if not n:
+            break
+        received += n
+    return received
+
+
+def measure(func, *args):
+    """Run func, return its result, duration and traced allocation peak"""
+    tracemalloc.reset_peak()
+    current = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+    result = func(*args)
+    duration = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1] - current
+    return result, duration, peak
+
+
+def bench_uart_to_tcp(args, device, clients):
+    size, burst = args.size, args.burst
+    payload = bytes(range(256)) * (burst // 256 + 1)
+
+    def run():
+        results = [0] * len(clients)
+
+        def reader(i):
+            results[i] = receive(clients[i], size, bytearray(65536))
+
+        threads = [start_thread(reader, i) for i in range(len(clients))]
+        sent = 0
+        while sent < size:
+            n = min(burst, size - sent)
+            sent += os.write(device, payload[:n])
+            if args.gap:
+                time.sleep(args.gap / 1000)
+        for thread in threads:
+            thread.join()
+        return results
+
+    received, duration, peak = measure(run)
+    return dict(bytes=size, received=received, seconds=duration,
+                mb_per_s=size / duration / 1e6 if duration else None,
+                alloc_peak_kib_per_mb=peak / 1024 / (size / 1e6))
+
+
+def bench_tcp_to_uart(args, device, clients):
+    size, burst = args.size, args.burst
+    payload = bytes(range(256)) * (burst // 256 + 1)
+
+    def run():
+        result = []
+
+        def reader():
+            received = 0
+            while received < size:
+                received += len(os.read(device, 65536))
+            result.append(received)
+
+        thread = start_thread(reader)
+        sent = 0
+        while sent < size:
+            n = min(burst, size - sent)
+            clients[0].sendall(payload[:n])
+            sent += n
+            if args.gap:
+                time.sleep(args.gap / 1000)
+        thread.join()
+        return result[0]
+
+    received, duration, peak = measure(run)
+    return dict(bytes=size, received=received, seconds=duration,
+                mb_per_s=size / duration / 1e6 if duration else None,
+                alloc_peak_kib_per_mb=peak / 1024 / (size / 1e6))
+
+
+def bench_rtt(args, device, clients):
+    start_thread(ptyserver.server_loop, {device: ptyserver.Echo()})
+    client = clients[0]
+    line = b'x' * (args.payload - 1) + b'\n'
+    buf = bytearray(65536)
+    samples = []
+    for _ in range(args.rtt):
+        start = time.perf_counter()
+        client.sendall(line)
+        receive(client, len(line), buf)
+        samples.append((time.perf_counter() - start) * 1000)
+    return dict(samples=len(samples), payload=len(line),
+                p50_ms=percentile(samples, 50), p99_ms=percentile(samples, 99),
+                max_ms=max(samples))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--target', default='us2n', choices=list(TARGETS))
+    parser.add_argument('--port', default=20300, type=int,
+                        help='TCP port of the bridge')
+    parser.add_argument('--size', default=4*1000*1000, type=int,
+                        help='bytes per throughput test')
+    parser.add_argument('--burst', default=4096, type=int,
+                        help='bytes per write')
+    parser.add_argument('--gap', default=0, type=float,
+                        help='pause (ms) between bursts')
+    parser.add_argument('--clients', default=1, type=int)
+    parser.add_argument('--payload', default=64, type=int,
+                        help='bytes per round trip')
+    parser.add_argument('--rtt', default=1000, type=int,
+                        help='number of round trips')
+    parser.add_argument('--baudrate', default=115200, type=int)
+    parser.add_argument('--chunk', default=256, type=int,
+                        help='us2n uart chunk')
+    parser.add_argument('--queue-size', default=64*1024, type=int,
+                        help='us2n per client queue size')
+    parser.add_argument('--output', default=None,
+                        help='write the JSON results to this file')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    if args.target.startswith('s2n') and args.clients != 1:
+        parser.error('s2n serves a single client per port')
+
+    tracemalloc.start()
+    device, get_stats = TARGETS[args.target](args)
+    clients = connect(args, args.clients)
+    results = dict(
+        target=args.target, params=vars(args), time=time.time(),
+        python=sys.version, platform=platform.platform(),
+        uart_to_tcp=bench_uart_to_tcp(args, device, clients),
+        tcp_to_uart=bench_tcp_to_uart(args, device, clients),
+        rtt=bench_rtt(args, device, clients))
+    results['stats'] = get_stats()
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    print(output)
+    # daemon threads block in selectors: do not wait for them
+    os._exit(0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+# machine.py
+#
+# Minimal stand-in for the MicroPython machine module, to run us2n on
+# Linux (see bench.py). Each UART is one end of a pseudo terminal; the
+# other end (UART.device) plays the part of the serial device.
+
+import os
+import pty
+import select
+import tty
+import fcntl
+import array
+import termios
+
+
+class UART:
+
+    # port -> UART, for the benchmark to find the device ends
+    instances = {}
+
+    def __init__(self, port, *args, **kwargs):
+        self.port = port
+        self.device, self.fd = pty.openpty()
+        tty.setraw(self.device)
+        tty.setraw(self.fd)
+        os.set_blocking(self.fd, False)
+        self.config = {}
+        UART.instances[port] = self
+
+    def init(self, **kwargs):
+        self.config.update(kwargs)
+
+    def deinit(self):
+        os.close(self.fd)
+        os.close(self.device)
+
+    def fileno(self):
+        return self.fd
+
+    def any(self):
+        count = array.array('i', [0])
+        fcntl.ioctl(self.fd, termios.FIONREAD, count)
+        return count[0]
+
+    def read(self, nbytes=-1):
+        try:
+            return os.read(self.fd, nbytes if nbytes > 0 else 4096) or None
+        except BlockingIOError:
+            return None
+
+    def readinto(self, buf, nbytes=None):
+        view = memoryview(buf)
+        if nbytes is not None:
+            view = view[:nbytes]
+        try:
+            return os.readv(self.fd, [view]) or None
+        except BlockingIOError:
+            return None
+
+    def write(self, buf):
+        view = memoryview(buf)
+        while view:
+            try:
+                view = view[os.write(self.fd, view):]
+            except BlockingIOError:
+                select.select((), (self.fd,), ())
+        return len(buf)
+
+    def sendbreak(self):
+        termios.tcsendbreak(self.fd, 0)
+
+
+class Pin:
+
+    OUT = 1
+
+    def __init__(self, pin, mode=None, value=0):
+        self.level = value
+
+    def value(self, level=None):
+        if level is None:
+            return self.level
+        self.level = level
@@ -0,0 +1,37 @@
+# network.py
+#
+# Minimal stand-in for the MicroPython network module, to run us2n on
+# Linux (see bench.py): interfaces are always up.
+
+STA_IF, AP_IF = 0, 1
+AUTH_OPEN = 0
+
+
+class WLAN:
+
+    def __init__(self, interface):
+        self.interface = interface
+        self._active = True
+        self._config = {}
+
+    def active(self, *args):
+        if args:
+            self._active = args[0]
+        return self._active
+
+    def isconnected(self):
+        return True
+
+    def connect(self, *args, **kwargs):
+        pass
+
+    def disconnect(self):
+        pass
+
+    def config(self, *args, **kwargs):
+        self._config.update(kwargs)
+        if args:
+            return self._config.get(args[0])
+
+    def ifconfig(self):
+        return '127.0.0.1', '255.0.0.0', '127.0.0.1', '127.0.0.1'
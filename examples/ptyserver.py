@@ -43,6 +43,15 @@ class SCPI(BaseReqRepDevice):
         return b'ERR!'
 
 
+class Echo(BaseReqRepDevice):
+
+    def handle_request(self, msg):
+        return msg
+
+
+DEVICES = {'scpi': SCPI, 'echo': Echo}
+
+
 def server_loop(devices):
     comms = devices.keys()
     while True:
@@ -62,6 +71,7 @@ def server_loop(devices):
 def main():
     parser = argparse.ArgumentParser(description='pty server')
     parser.add_argument('--address', default=None)
+    parser.add_argument('--device', default='scpi', choices=list(DEVICES))
     parser.add_argument('--log-level', default='INFO', help='log level',
                         choices=['CRITICAL', 'ERROR', 'WARNING', 'INFO', 'DEBUG'])
     args = parser.parse_args()
@@ -88,7 +98,7 @@ def main():
     log.info('Ready to accept request at %r', address)
 
     try:
-        server_loop({master: SCPI()})
+        server_loop({master: DEVICES[args.device]()})
     except KeyboardInterrupt:
         log.info('Ctrl-C pressed. Bailing out!')
 
@@ -1,16 +1,24 @@
 #
 
 import os
+import sys
+import json
+import time
 import select
+import signal
 import socket
 import logging
 import argparse
+import selectors
+import multiprocessing
 
 import serial
 
 
 log = logging.getLogger(os.path.splitext(__file__)[0])
 
+LOG_FORMAT = '%(asctime)-15s %(levelname)-5s %(name)s: %(message)s'
+
 
 def SerialLine(**opts):
     dtr = opts.pop('dtr')
@@ -23,50 +31,684 @@ def SerialLine(**opts):
     return serial_line
 
 
-def server_loop(tcp_addr, serial_opts):
-    tcp_server = socket.socket()
-    tcp_server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    tcp_server.bind(tcp_addr)
-    tcp_server.listen(5)
-    log.info('server listening at %r', tcp_addr)
+def serial_error(error):
+    """An OSError of a serial line as a SerialException, which gets the
+    line closed and reopened (ex: EIO once a pty or an adapter hung up)"""
+    if isinstance(error, serial.SerialException):
+        return error
+    return serial.SerialException('serial line: {0}'.format(error))
+
+
+def parse_bind_address(addr):
+    args = addr
+    if not isinstance(args, (list, tuple)):
+        args = addr.rsplit(':', 1)
+    host = '' if len(args) == 1 or args[0] == '0' else args[0]
+    return host, int(args[-1])
+
+
+PARITIES = {None: 'N', 'None': 'N', 'Even': 'E', 'Odd': 'O',
+            'Mark': 'M', 'Space': 'S', 0: 'E', 1: 'O'}
+
+
+def serial_options(uart):
+    """serial.Serial options from a us2n.json "uart" section"""
+    parity = uart.get('parity')
+    return dict(port=uart['port'], baudrate=uart.get('baudrate', 9600),
+                bytesize=uart.get('bits', 8),
+                parity=PARITIES.get(parity, parity),
+                stopbits=uart.get('stop', 1),
+                rtscts=uart.get('rtscts', False),
+                xonxoff=uart.get('xonxoff', False),
+                rts=uart.get('rts'), dtr=uart.get('dtr'))
+
+
+class Listener:
+    """Something listening on a TCP port, served by serve()"""
+
+    def __init__(self, tcp_addr, name):
+        self.tcp_addr = tcp_addr
+        self.name = name
+        self.selector = None
+        self.tcp_server = None
+        self.stats = dict(connections=0, errors=0)
+
+    def __repr__(self):
+        return '{0}({1}, {2!r})'.format(type(self).__name__, self.name,
+                                        self.tcp_addr)
+
+    def register(self, fileobj, handler):
+        self.selector.register(fileobj, selectors.EVENT_READ,
+                               (self, handler, None))
+
+    def set_events(self, fileobj, events, reader, writer=None):
+        """(Re)register fileobj for events (0: none), reader and writer
+        are called when it is readable and writable"""
+        try:
+            key = self.selector.get_key(fileobj)
+        except KeyError:
+            key = None
+        if key is None:
+            if events:
+                self.selector.register(fileobj, events,
+                                       (self, reader, writer))
+        elif not events:
+            self.selector.unregister(fileobj)
+        elif key.events != events or key.data[2] is not writer:
+            self.selector.modify(fileobj, events, (self, reader, writer))
+
+    def unregister(self, fileobj):
+        if fileobj is not None:
+            try:
+                self.selector.unregister(fileobj)
+            except KeyError:
+                # not watched at the moment, see set_events()
+                pass
+            fileobj.close()
+
+    def ready(self):
+        return self.tcp_server is not None
+
+    def setup(self, selector):
+        """Open whatever is not open yet"""
+        self.selector = selector
+        if self.tcp_server is None:
+            self.bind()
+
+    def bind(self):
+        tcp_server = socket.socket()
+        try:
+            tcp_server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            tcp_server.bind(self.tcp_addr)
+            tcp_server.listen(5)
+        except OSError:
+            tcp_server.close()
+            raise
+        self.tcp_server = tcp_server
+        self.register(tcp_server, self.accept)
+        log.info('%s: server listening at %r', self.name, self.tcp_addr)
+
+    def fail(self, error):
+        log.error('%s: %r', self.name, error)
+        self.stats['errors'] += 1
+
+    def close(self):
+        self.unregister(self.tcp_server)
+        self.tcp_server = None
+
+
+class Port(Listener):
+    """A serial line served on a TCP port.
+
+    The serial line stays open across client connections. What it sends
+    while nobody is connected is kept (last *backlog* bytes) and replayed
+    to the next client.
+
+    *packet* (dict) holds serial data until *size* bytes wait, a
+    *delimiter* is read or the line was idle for *timeout* ms. *nodelay*
+    sends every read at once, with TCP_NODELAY.
+
+    *capture* (dict) records the traffic to a file, see us2ncap.Capture.
+
+    The client socket is non-blocking and the serial line is written only
+    when it is writable: what could not be written waits for the other
+    side to be writable, so that a slow client or line does not hold up
+    the other ports. Past *max_pending* bytes waiting, the other side is
+    not read until they are written"""
+
+    def __init__(self, tcp_addr, serial_opts, name=None, backlog=16*1024,
+                 packet=None, nodelay=False, capture=None,
+                 max_pending=256*1024):
+        super().__init__(tcp_addr, name or serial_opts['port'])
+        self.serial_opts = serial_opts
+        self.serial_line = None
+        self.tcp_client, self.addr_client = None, None
+        self.backlog_size = backlog
+        self.backlog = bytearray()
+        self.nodelay = nodelay
+        self.packet = packet if packet and not nodelay else None
+        if self.packet is not None:
+            delimiter = packet.get('delimiter')
+            self.delimiter = delimiter.encode() if delimiter else None
+            self.packet_size = packet.get('size', 1024)
+            self.packet_timeout = packet.get('timeout', 50) / 1000
+        # serial data held back and the time.monotonic() it is due
+        self.held = bytearray()
+        self.due = None
+        self.max_pending = max_pending
+        # data waiting for the socket and for the serial line
+        self.to_tcp = bytearray()
+        self.to_serial = bytearray()
+        self.stats.update(tcp_to_serial=0, serial_to_tcp=0, serial_reads=0,
+                          backlog_dropped=0, tcp_sends=0, partial_writes=0)
+        self.capture = None
+        if capture is not None:
+            import us2ncap
+            self.capture = us2ncap.Capture(stats=self.stats, **capture)
+
+    def ready(self):
+        return self.tcp_server is not None and self.serial_line is not None
+
+    def setup(self, selector):
+        """Open whatever is not open yet (listener, serial line)"""
+        self.selector = selector
+        if self.serial_line is None:
+            self.open_serial()
+        super().setup(selector)
+
+    def open_serial(self):
+        self.serial_line = SerialLine(**self.serial_opts)
+        self.serial_line.write_timeout = 0
+        self.register(self.serial_line, self.serial_ready)
+        log.info('%s: serial line open', self.name)
+
+    def accept(self):
+        if self.tcp_client:
+            log.info('%s: closing previous client %s', self.name,
+                     self.addr_client)
+            self.close_client()
+        tcp_client, addr_client = self.tcp_server.accept()
+        log.info('%s: new connection from %s', self.name, addr_client)
+        self.stats['connections'] += 1
+        self.setup_client(tcp_client)
+        if self.serial_line is None:
+            try:
+                self.open_serial()
+            except (serial.SerialException, OSError) as error:
+                log.error('%s: could not open serial line: %s', self.name,
+                          error)
+                self.stats['errors'] += 1
+                tcp_client.close()
+                return
+        self.tcp_client, self.addr_client = tcp_client, addr_client
+        self.register(tcp_client, self.client_ready)
+        if self.backlog:
+            backlog = self.backlog[-self.backlog_size:]
+            log.debug('%s: replay %d bytes', self.name, len(backlog))
+            self.stats['backlog_dropped'] += len(self.backlog) - len(backlog)
+            self.backlog = bytearray()
+            self.send(backlog)
+
+    def setup_client(self, tcp_client):
+        if self.nodelay:
+            tcp_client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        tcp_client.setblocking(False)
+
+    def update_events(self):
+        """Watch for writability while data waits, stop reading a side
+        while too much of its data waits for the other side"""
+        read, write = selectors.EVENT_READ, selectors.EVENT_WRITE
+        if self.serial_line is not None:
+            events = 0 if len(self.to_tcp) > self.max_pending else read
+            self.set_events(self.serial_line,
+                            events | (write if self.to_serial else 0),
+                            self.serial_ready, self.serial_writable)
+        if self.tcp_client is not None:
+            events = 0 if len(self.to_serial) > self.max_pending else read
+            self.set_events(self.tcp_client,
+                            events | (write if self.to_tcp else 0),
+                            self.client_ready, self.tcp_writable)
+
+    def send(self, data):
+        self.stats['serial_to_tcp'] += len(data)
+        self.stats['tcp_sends'] += 1
+        to_tcp = self.to_tcp
+        if not to_tcp:
+            try:
+                n = self.tcp_client.send(data)
+            except BlockingIOError:
+                n = 0
+            if n == len(data):
+                return
+            data = memoryview(data)[n:]
+            self.stats['partial_writes'] += 1
+        to_tcp += data
+        self.update_events()
+
+    def tcp_writable(self):
+        try:
+            n = self.tcp_client.send(self.to_tcp)
+        except BlockingIOError:
+            return
+        del self.to_tcp[:n]
+        self.update_events()
+
+    def read_serial(self):
+        try:
+            return self.serial_line.read(self.serial_line.in_waiting)
+        except OSError as error:
+            raise serial_error(error)
+
+    def serial_ready(self):
+        data = self.read_serial()
+        self.stats['serial_reads'] += 1
+        if not data:
+            return
+        if self.capture is not None:
+            self.capture.from_serial(data)
+        if self.tcp_client is None:
+            self.keep(data)
+            return
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug('%s: SL:Rx -> TCP:Tx %r', self.name, bytes(data))
+        if self.packet is None:
+            self.send(data)
+            return
+        held = self.held
+        held += data
+        delimited = False
+        if self.delimiter is not None:
+            # the delimiter may start in the data held before
+            start = len(held) - len(data) - len(self.delimiter) + 1
+            delimited = held.find(self.delimiter, max(0, start)) >= 0
+        if delimited or len(held) >= self.packet_size:
+            self.flush()
+        else:
+            self.due = time.monotonic() + self.packet_timeout
+
+    def flush(self):
+        held, self.held, self.due = self.held, bytearray(), None
+        if held:
+            self.send(held)
+
+    def packet_wait(self, now):
+        """Seconds before the held data is due, None if none is held"""
+        return None if self.due is None else max(0, self.due - now)
+
+    def keep(self, data):
+        backlog = self.backlog
+        backlog += data
+        # trim only once in a while to keep appends cheap
+        if len(backlog) > 2 * self.backlog_size:
+            excess = len(backlog) - self.backlog_size
+            self.stats['backlog_dropped'] += excess
+            del backlog[:excess]
+
+    def client_ready(self):
+        try:
+            data = self.tcp_client.recv(4096)
+        except BlockingIOError:
+            return
+        if data:
+            self.write_serial(data)
+        else:
+            log.debug('%s: client %s disconnected', self.name,
+                      self.addr_client)
+            self.close_client()
+
+    def serial_write(self, data):
+        """Write what the serial line takes now, returns its length"""
+        # with write_timeout=0, pyserial returns what was written but
+        # spins while the line is full: write only once it is writable
+        if not select.select([], [self.serial_line], [], 0)[1]:
+            return 0
+        try:
+            return self.serial_line.write(data) or 0
+        except OSError as error:
+            raise serial_error(error)
+
+    def write_serial(self, data):
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug('%s: TCP:Rx -> SL:Tx %r', self.name, bytes(data))
+        self.stats['tcp_to_serial'] += len(data)
+        if self.capture is not None:
+            self.capture.to_serial(data)
+        to_serial = self.to_serial
+        if not to_serial:
+            n = self.serial_write(data)
+            if n == len(data):
+                return
+            data = data[n:]
+            self.stats['partial_writes'] += 1
+        to_serial += data
+        self.update_events()
+
+    def serial_writable(self):
+        n = self.serial_write(self.to_serial)
+        del self.to_serial[:n]
+        self.update_events()
+
+    def close_client(self):
+        # serial data not sent yet is kept for the next client
+        if self.to_tcp:
+            self.keep(self.to_tcp)
+        if self.held:
+            self.keep(self.held)
+        self.to_tcp, self.held, self.due = bytearray(), bytearray(), None
+        self.unregister(self.tcp_client)
+        self.tcp_client, self.addr_client = None, None
+        self.update_events()
+
+    def close_serial(self):
+        self.to_serial = bytearray()
+        self.unregister(self.serial_line)
+        self.serial_line = None
+
+    def fail(self, error):
+        """An error on this port: drop its connection, keep the others.
+        A failed serial line is closed too, and reopened later"""
+        log.error('%s: %r, closing connection', self.name, error)
+        self.stats['errors'] += 1
+        self.close_client()
+        if isinstance(error, serial.SerialException):
+            self.close_serial()
+
+    def close(self):
+        self.close_client()
+        self.close_serial()
+        super().close()
+        if self.capture is not None:
+            self.capture.close()
+
+
+class FdPort(Port):
+    """Linux fast path of Port: the serial line (opened and set up by
+    pyserial) is a non-blocking file descriptor. Data is read into a
+    reusable buffer of *buffer* bytes with os.readv()/recv_into() and
+    written with os.write()"""
 
-    fds = [tcp_server]
-    serial_line = None
-    tcp_client, addr_client = None, None
+    def __init__(self, tcp_addr, serial_opts, name=None, backlog=16*1024,
+                 packet=None, nodelay=False, capture=None,
+                 buffer=64*1024, max_pending=256*1024):
+        super().__init__(tcp_addr, serial_opts, name, backlog, packet,
+                         nodelay, capture, max_pending)
+        self.buffer = bytearray(buffer)
+        self.view = memoryview(self.buffer)
 
-    with tcp_server:
+    def open_serial(self):
+        super().open_serial()
+        os.set_blocking(self.serial_line.fileno(), False)
+
+    def read_serial(self):
+        try:
+            n = os.readv(self.serial_line.fileno(), [self.view])
+        except BlockingIOError:
+            return None
+        except OSError as error:
+            raise serial_error(error)
+        if not n:
+            # ex: USB adapter unplugged
+            raise serial.SerialException('serial line hung up')
+        return self.view[:n]
+
+    def client_ready(self):
+        try:
+            n = self.tcp_client.recv_into(self.view)
+        except BlockingIOError:
+            return
+        if n:
+            self.write_serial(self.view[:n])
+        else:
+            log.debug('%s: client %s disconnected', self.name,
+                      self.addr_client)
+            self.close_client()
+
+    def serial_write(self, data):
+        try:
+            return os.write(self.serial_line.fileno(), data)
+        except BlockingIOError:
+            return 0
+        except OSError as error:
+            raise serial_error(error)
+
+
+ENGINES = {'pyserial': Port, 'fd': FdPort}
+
+
+def port_class(engine='auto'):
+    """Port class of an engine: 'fd' (the default on Linux) or
+    'pyserial'"""
+    if engine == 'auto':
+        engine = 'fd' if sys.platform.startswith('linux') else 'pyserial'
+    return ENGINES[engine]
+
+
+class Worker:
+    """A process serving shard *index* (of *workers*) of the bridges of
+    the *config* file, run by supervise(). It is served by serve() like a
+    port: setup() starts the process, which reports the stats of its
+    ports every second"""
+
+    # no serial data held, no capture here
+    due = None
+    capture = None
+
+    def __init__(self, config, index, workers, engine='auto',
+                 log_level=None):
+        self.config = config
+        self.index = index
+        self.workers = workers
+        self.engine = engine
+        self.log_level = log_level
+        self.name = 'worker{0}'.format(index)
+        self.process = None
+        self.conn = None
+        self.selector = None
+        self.stats = dict(pid=None, starts=0, errors=0, ports={})
+
+    def __repr__(self):
+        return 'Worker({0}, {1}/{2})'.format(self.config, self.index,
+                                             self.workers)
+
+    def ready(self):
+        return self.process is not None
+
+    def setup(self, selector):
+        self.selector = selector
+        # a fresh interpreter: no listener or descriptor of the supervisor
+        # or of the other workers is inherited
+        context = multiprocessing.get_context('spawn')
+        conn, child_conn = context.Pipe(duplex=False)
+        process = context.Process(
+            target=run_worker, name=self.name, daemon=True,
+            args=(self.config, self.index, self.workers, self.engine,
+                  self.log_level, child_conn))
+        process.start()
+        child_conn.close()
+        self.process, self.conn = process, conn
+        self.stats['pid'] = process.pid
+        self.stats['starts'] += 1
+        selector.register(conn, selectors.EVENT_READ,
+                          (self, self.receive, None))
+        selector.register(process.sentinel, selectors.EVENT_READ,
+                          (self, self.exited, None))
+        log.info('%s: started, pid %d', self.name, process.pid)
+
+    def packet_wait(self, now):
+        return None
+
+    def receive(self):
+        try:
+            self.stats['ports'] = self.conn.recv()
+        except EOFError:
+            self.exited()
+
+    def exited(self):
+        self.process.join()
+        log.error('%s: exited with code %s, restarting', self.name,
+                  self.process.exitcode)
+        self.stats['errors'] += 1
+        self.stop()
+
+    def stop(self):
+        self.selector.unregister(self.conn)
+        self.selector.unregister(self.process.sentinel)
+        self.conn.close()
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join(5)
+            if self.process.is_alive():
+                self.process.kill()
+                self.process.join()
+        self.process.close()
+        self.process, self.conn = None, None
+
+    def fail(self, error):
+        log.error('%s: %r', self.name, error)
+        self.stats['errors'] += 1
+        self.stop()
+
+    def close(self):
+        if self.process is not None:
+            self.stop()
+
+
+WORKER_REPORT = 1
+
+
+def run_worker(config, index, workers, engine, log_level, conn):
+    """Worker process: serve shard *index* of the bridges of *config*,
+    report the stats through *conn*"""
+    if log_level is not None:
+        logging.basicConfig(level=log_level, format=LOG_FORMAT)
+    # terminate(): close the ports (and captures) on the way out
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+
+    def report(ports):
+        conn.send({port.name: port.stats for port in ports})
+
+    try:
+        serve(read_config(config, engine, (index, workers)),
+              stats_interval=WORKER_REPORT, report=report)
+    except KeyboardInterrupt:
+        pass
+
+
+def supervise(config, workers, engine='auto', retry=5, stats_interval=0,
+              stats_addr=None, log_level=None):
+    """Serve the bridges of the *config* file from *workers* processes,
+    each owning a shard of them (listeners and serial lines). A worker
+    which dies is started again within *retry* seconds, the others are
+    not disturbed. The stats of all ports are served from here"""
+    serve([Worker(config, index, workers, engine, log_level)
+           for index in range(workers)],
+          retry, stats_interval, stats_addr, stats_class=SupervisorStats)
+
+
+class StatsPort(Listener):
+    """Sends a JSON dump of the stats of all ports to whoever connects"""
+
+    def __init__(self, tcp_addr, ports):
+        super().__init__(tcp_addr, 'stats')
+        self.ports = ports
+        self.stats.update(wakeups=0)
+
+    def get_stats(self):
+        return dict(self.stats, ports={port.name: port.stats
+                                       for port in self.ports})
+
+    def accept(self):
+        tcp_client, addr_client = self.tcp_server.accept()
+        self.stats['connections'] += 1
+        with tcp_client:
+            tcp_client.sendall(json.dumps(self.get_stats()).encode() + b'\n')
+
+
+class SupervisorStats(StatsPort):
+    """Stats of the ports of all workers, with their totals"""
+
+    def get_stats(self):
+        ports, totals, workers = {}, {}, {}
+        for worker in self.ports:
+            workers[worker.name] = {key: value for key, value
+                                    in worker.stats.items() if key != 'ports'}
+            for name, stats in worker.stats['ports'].items():
+                ports[name] = stats
+                for key, value in stats.items():
+                    totals[key] = totals.get(key, 0) + value
+        return dict(self.stats, ports=ports, totals=totals, workers=workers)
+
+
+def serve(ports, retry=5, stats_interval=0, stats_addr=None,
+          report=None, stats_class=StatsPort):
+    """Serve all ports from a single event loop. Ports which fail to bind
+    or to open their serial line are retried every *retry* seconds. Per
+    port stats are logged (or given to *report*) every *stats_interval*
+    seconds (0 means only logged on exit) and sent as JSON to clients of
+    *stats_addr*"""
+    selector = selectors.DefaultSelector()
+    listeners = list(ports)
+    stats_port = None
+    if stats_addr is not None:
+        stats_port = stats_class(stats_addr, ports)
+        listeners.append(stats_port)
+    next_retry = next_stats = time.monotonic()
+    try:
         while True:
-            rlist, _, xlist = select.select(fds, (), fds)
-            if xlist:
-                print('errors. bailing out')
-                exit(1)
-            for fd in rlist:
-                if fd == tcp_server:
-                    if tcp_client:
-                        log.info('Closing previous client %s', addr_client)
-                        tcp_client.close()
-                    if serial_line:
-                        serial_line.close()
-                    tcp_client, addr_client = tcp_server.accept()
-                    log.info('new connection from %s', addr_client)
-                    serial_line = SerialLine(**serial_opts)
-                    fds = [tcp_server, tcp_client, serial_line]
-                    break
-                elif fd == serial_line:
-                    data = serial_line.read(serial_line.in_waiting)
-                    if tcp_client:
-                        log.debug('SL:Rx -> TCP:Tx %r', data)
-                        tcp_client.sendall(data)
-                elif fd == tcp_client:
-                    data = tcp_client.recv(4096)
-                    if data:
-                        log.debug('TCP:Rx -> SL:Tx %r', data)
-                        serial_line.write(data)
-                    else:
-                        log.debug('client %s disconnected', addr_client)
-                        fds = [tcp_server]
-                        serial_line = None
-                        tcp_client, addr_client = None, None
+            now = time.monotonic()
+            if now >= next_retry:
+                next_retry = now + retry
+                for port in listeners:
+                    if port.ready():
+                        continue
+                    try:
+                        port.setup(selector)
+                    except (OSError, serial.SerialException) as error:
+                        log.error('%s: setup failed: %s', port.name, error)
+            if stats_interval and now >= next_stats:
+                next_stats = now + stats_interval
+                (report or log_stats)(ports)
+            timeout = 1
+            for port in ports:
+                wait = port.packet_wait(now)
+                if wait is not None and wait < timeout:
+                    timeout = wait
+            events = selector.select(timeout=timeout)
+            if events and stats_port is not None:
+                stats_port.stats['wakeups'] += 1
+            for key, mask in events:
+                if key.fd not in selector.get_map():
+                    # closed by a previous handler
+                    continue
+                port, reader, writer = key.data
+                try:
+                    if mask & selectors.EVENT_WRITE:
+                        writer()
+                    if mask & selectors.EVENT_READ and \
+                       key.fd in selector.get_map():
+                        reader()
+                except (OSError, serial.SerialException) as error:
+                    port.fail(error)
+            now = time.monotonic()
+            for port in ports:
+                if port.due is not None and now >= port.due:
+                    try:
+                        port.flush()
+                    except OSError as error:
+                        port.fail(error)
+                if port.capture is not None:
+                    port.capture.tick()
+    finally:
+        log_stats(ports)
+        for port in listeners:
+            port.close()
+        selector.close()
+
+
+def log_stats(ports):
+    for port in ports:
+        log.info('%s: %r', port.name, port.stats)
+
+
+def server_loop(tcp_addr, serial_opts):
+    serve([Port(tcp_addr, serial_opts)])
+
+
+def read_config(filename, engine='auto', shard=None):
+    """Ports from a configuration file with the us2n.json "bridges" schema,
+    where uart "port" is the serial port name. *shard* (index, count)
+    selects every count-th bridge from index"""
+    with open(filename) as f:
+        config = json.load(f)
+    bridges = config['bridges']
+    if shard is not None:
+        bridges = bridges[shard[0]::shard[1]]
+    port_type = port_class(engine)
+    return [port_type(parse_bind_address(bridge['tcp']['bind']),
+                 serial_options(bridge['uart']), bridge.get('name'),
+                 bridge.get('backlog', 16*1024), bridge.get('packet'),
+                 bridge['tcp'].get('nodelay', False), bridge.get('capture'))
+            for bridge in bridges]
 
 
 def main(default_bind=':20202', default_port=None, default_baudrate=9600,
@@ -84,7 +726,37 @@ def main(default_bind=':20202', default_port=None, default_baudrate=9600,
     parser.add_argument('--bind', default=default_bind,
                         help='TCP bind address (ex: ":40506")')
 
-    parser.add_argument('port', default=default_port,
+    parser.add_argument('--config', default=None,
+                        help='serve all bridges of a us2n.json like file '
+                             'instead of a single port')
+    parser.add_argument('--stats-interval', default=0, type=float,
+                        help='log per port stats every N seconds')
+    parser.add_argument('--stats-bind', default=None,
+                        help='TCP address serving the stats as JSON '
+                             '(ex: ":40500")')
+    parser.add_argument('--backlog', default=16*1024, type=int,
+                        help='serial data kept while no client is '
+                             'connected, default: %(default)s bytes')
+    parser.add_argument('--packet-size', default=None, type=int,
+                        help='hold serial data until N bytes wait')
+    parser.add_argument('--packet-delimiter', default=None,
+                        help='... or until this delimiter is read')
+    parser.add_argument('--packet-timeout', default=None, type=float,
+                        help='... or until the line is idle for N ms')
+    parser.add_argument('--nodelay', default=False, action='store_true',
+                        help='send every read at once, with TCP_NODELAY')
+    parser.add_argument('--workers', default=0, type=int,
+                        help='with --config, serve the bridges from N '
+                             'worker processes (restarted if they die)')
+    parser.add_argument('--engine', default='auto',
+                        choices=['auto', 'fd', 'pyserial'],
+                        help='serial I/O: non-blocking file descriptors '
+                             '(fd, the default on Linux) or pyserial calls')
+    parser.add_argument('--capture', default=None,
+                        help='record the traffic to this file (decode it '
+                             'with us2ncap.py)')
+
+    parser.add_argument('port', default=default_port, nargs='?',
                         help="serial port name (ex: /dev/ttyUSB0")
 
     group = parser.add_argument_group("port settings")
@@ -112,16 +784,45 @@ def main(default_bind=':20202', default_port=None, default_baudrate=9600,
     vargs = vars(args)
     log_level = vargs.pop('log_level')
     if log_level is not None:
-        fmt = '%(asctime)-15s %(levelname)-5s %(name)s: %(message)s'
-        logging.basicConfig(level=log_level, format=fmt)
+        logging.basicConfig(level=log_level, format=LOG_FORMAT)
 
-    tcp_addr = vargs.pop('bind').rsplit(':', 1)
-    if len(tcp_addr) == 1:
-        tcp_addr.insert(0, '')
-    tcp_addr[1] = int(tcp_addr[1])
+    config = vargs.pop('config')
+    stats_interval = vargs.pop('stats_interval')
+    stats_addr = vargs.pop('stats_bind')
+    if stats_addr is not None:
+        stats_addr = parse_bind_address(stats_addr)
+    backlog = vargs.pop('backlog')
+    nodelay = vargs.pop('nodelay')
+    capture = vargs.pop('capture')
+    engine = vargs.pop('engine')
+    workers = vargs.pop('workers')
+    if capture is not None:
+        capture = dict(file=capture)
+    packet = {key: vargs.pop('packet_' + key)
+              for key in ('size', 'delimiter', 'timeout')}
+    packet = {key: value for key, value in packet.items()
+              if value is not None} or None
+    tcp_addr = parse_bind_address(vargs.pop('bind'))
+    if workers:
+        if config is None:
+            parser.error('--workers needs --config')
+        try:
+            supervise(config, workers, engine, stats_interval=stats_interval,
+                      stats_addr=stats_addr, log_level=log_level)
+        except KeyboardInterrupt:
+            log.info('Ctrl-C pressed. Bailing out!')
+        return
+    if config is not None:
+        ports = read_config(config, engine)
+    elif vargs['port'] is not None:
+        ports = [port_class(engine)(tcp_addr, vargs, backlog=backlog,
+                                    packet=packet, nodelay=nodelay,
+                                    capture=capture)]
+    else:
+        parser.error('either a serial port or --config is required')
 
     try:
-        server_loop(tuple(tcp_addr), vargs)
+        serve(ports, stats_interval=stats_interval, stats_addr=stats_addr)
     except KeyboardInterrupt:
         log.info('Ctrl-C pressed. Bailing out!')
 
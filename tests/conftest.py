@@ -0,0 +1,13 @@
+import os
+import sys
+import types
+
+# us2n imports the MicroPython machine and network modules at load time;
+# the parts under test do not use them (us2n_telnet only looks for the
+# flow control flags of machine.UART)
+for name in ('machine', 'network'):
+    sys.modules.setdefault(name, types.ModuleType(name))
+if not hasattr(sys.modules['machine'], 'UART'):
+    sys.modules['machine'].UART = type('UART', (), {})
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
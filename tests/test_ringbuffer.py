@@ -0,0 +1,229 @@
+import random
+
+from us2n import RINGBUFFER, Cursor
+
+
+def fill(ring, data):
+    ring.put(data)
+    return data
+
+
+def drain(ring):
+    data = bytearray()
+    while ring.has_data():
+        region = ring.peek()
+        data += region
+        ring.commit(len(region))
+    return bytes(data)
+
+
+def test_empty():
+    ring = RINGBUFFER(8)
+    assert len(ring) == 0 and ring.free() == 8
+    assert not ring.has_data()
+    assert ring.getc() is None
+    assert len(ring.peek()) == 0
+
+
+def test_put_get():
+    ring = RINGBUFFER(8)
+    ring.put(b'abc')
+    assert len(ring) == 3 and ring.free() == 5
+    assert ring.get(2) == b'ab'
+    assert ring.getc() == ord('c')
+    assert not ring.has_data()
+
+
+def test_peek_is_contiguous_across_wrap():
+    ring = RINGBUFFER(8)
+    ring.put(b'123456')
+    ring.commit(5)
+    ring.put(b'abcde')
+    # '6abcde' wraps: the first region ends at the end of the buffer
+    assert bytes(ring.peek()) == b'6ab'
+    ring.commit(3)
+    assert bytes(ring.peek()) == b'cde'
+    ring.commit(3)
+    assert not ring.has_data()
+    assert ring.index_get == ring.index_put == 3
+
+
+def test_reserve_produce_across_wrap():
+    ring = RINGBUFFER(8)
+    ring.put(b'123456')
+    ring.commit(6)
+    region = ring.reserve()
+    assert len(region) == 2
+    region[:] = b'ab'
+    ring.produce(2)
+    assert ring.index_put == 0
+    region = ring.reserve(3)
+    assert len(region) == 3
+    region[:] = b'cde'
+    ring.produce(3)
+    assert drain(ring) == b'abcde'
+
+
+def test_write_from():
+    ring = RINGBUFFER(8)
+    ring.put(b'1234567')
+    ring.commit(7)
+    source = bytearray(b'abcdef')
+
+    def readinto(buf):
+        n = min(len(buf), len(source))
+        buf[:n] = source[:n]
+        del source[:n]
+        return n or None
+
+    # one read fills up to the end of the buffer only
+    assert ring.write_from(readinto) == 1
+    assert ring.write_from(readinto, 4) == 4
+    assert ring.write_from(readinto) == 1
+    assert ring.write_from(readinto) == 0
+    assert drain(ring) == b'abcdef'
+
+
+def test_overflow_drops_oldest():
+    ring = RINGBUFFER(8)
+    ring.put(b'123456')
+    ring.put(b'abcd')
+    assert len(ring) == 8
+    assert ring.dropped == 2 and ring.overflows == 1
+    assert drain(ring) == b'3456abcd'
+
+
+def test_overflow_by_produce():
+    ring = RINGBUFFER(4)
+    ring.put(b'abc')
+    ring.reserve()[:1] = b'd'
+    ring.produce(1)
+    ring.reserve()[:2] = b'ef'
+    ring.produce(2)
+    assert ring.dropped == 2 and ring.overflows == 1
+    assert drain(ring) == b'cdef'
+
+
+def test_put_bigger_than_buffer():
+    ring = RINGBUFFER(4)
+    ring.put(b'xy')
+    ring.put(b'abcdefg')
+    # the two unread bytes and the first three of the data are lost
+    assert ring.dropped == 5
+    assert drain(ring) == b'defg'
+
+
+def test_putc():
+    ring = RINGBUFFER(2)
+    ring.putc(1)
+    ring.putc(2)
+    ring.putc(3)
+    assert ring.dropped == 1
+    assert drain(ring) == b'\x02\x03'
+
+
+def test_rewind_and_clear():
+    ring = RINGBUFFER(8)
+    ring.put(b'abcdef')
+    drain(ring)
+    ring.put(b'ghij')
+    drain(ring)
+    ring.rewind()
+    assert drain(ring) == b'cdefghij'
+    ring.clear()
+    assert not ring.has_data() and ring.dropped == 0
+    ring.rewind()
+    assert not ring.has_data()
+
+
+def test_external_buffer():
+    memory = bytearray(12)
+    ring = RINGBUFFER(8, memoryview(memory)[2:10])
+    ring.put(b'abcdefghij')
+    assert drain(ring) == b'cdefghij'
+    assert memory[:2] == memory[10:] == b'\x00\x00'
+
+
+def test_cursor_skips_overwritten_data():
+    ring = RINGBUFFER(4)
+    ring.put(b'ab')
+    cursor = Cursor(ring, ring.start())
+    ring.put(b'cdef')
+    assert len(cursor) == 4
+    data = bytearray()
+    while len(cursor):
+        region = cursor.peek()
+        data += region
+        cursor.commit(len(region))
+    assert data == b'cdef' and cursor.skipped == 2
+
+
+def test_ends_in_split_pattern():
+    ring = RINGBUFFER(16)
+    ring.put(b'abc\r')
+    assert not ring.ends_in(b'\r\n', 4)
+    ring.put(b'\nde')
+    # the pattern starts before the last 3 bytes written
+    assert ring.ends_in(b'\r\n', 3)
+    assert not ring.ends_in(b'\r\n', 1)
+    ring.put(b'f')
+    assert ring.ends_in(b'f', 1) and not ring.ends_in(b'e', 1)
+
+
+def test_ends_in_across_wrap():
+    ring = RINGBUFFER(8)
+    ring.put(b'123456')
+    ring.commit(6)
+    ring.put(b'7\r')
+    assert ring.index_put == 0
+    ring.put(b'\n9')
+    assert ring.ends_in(b'\r\n', 2)
+    assert ring.ends_in(b'7\r\n9', 2)
+    assert not ring.ends_in(b'6\r\n', 2)
+
+
+def test_ends_in_first_bytes():
+    ring = RINGBUFFER(8)
+    assert not ring.ends_in(b'ab', 0)
+    ring.put(b'b')
+    # nothing was written before: no room for the start of the pattern
+    assert not ring.ends_in(b'ab', 1)
+
+
+def test_against_model():
+    rand = random.Random(1)
+    for _ in range(200):
+        size = rand.randint(1, 16)
+        ring = RINGBUFFER(size)
+        model = bytearray()
+        dropped = 0
+        for _ in range(100):
+            action = rand.random()
+            if action < 0.4:
+                data = bytes(rand.randrange(256)
+                             for _ in range(rand.randint(0, 2 * size)))
+                ring.put(data)
+                model += data
+            elif action < 0.6:
+                region = ring.reserve(rand.randint(1, size))
+                n = rand.randint(0, len(region))
+                data = bytes(rand.randrange(256) for _ in range(n))
+                region[:n] = data
+                ring.produce(n)
+                model += data
+            elif action < 0.9:
+                region = ring.peek()
+                n = rand.randint(0, len(region))
+                assert bytes(region[:n]) == model[:n]
+                ring.commit(n)
+                del model[:n]
+            else:
+                n = rand.randint(0, size)
+                assert ring.get(n) == model[:n]
+                del model[:n]
+            if len(model) > size:
+                dropped += len(model) - size
+                del model[:len(model) - size]
+            assert len(ring) == len(model)
+            assert ring.dropped == dropped
+        assert drain(ring) == model
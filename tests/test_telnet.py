@@ -0,0 +1,123 @@
+from us2n_telnet import Telnet, escape, IAC, DO, WILL, SB, SE, BRK, \
+    COM_PORT_OPTION, SET_BAUDRATE, SET_DATASIZE, SET_PARITY
+
+
+class Client:
+    state = 'authenticated'
+
+
+class Bridge:
+    """What Telnet uses of a us2n Bridge, recording the calls"""
+
+    def __init__(self, writer=True):
+        self.config = {'uart': {'port': 1, 'baudrate': 9600, 'bits': 8}}
+        self.writer = writer
+        self.input = bytearray()
+        self.commands = []
+        self.sent = bytearray()
+        self.changes = []
+
+    def handle_input(self, client, data, start, end):
+        self.input += data[start:end]
+
+    def telnet_command(self, client, command):
+        self.commands.append(command)
+
+    def send(self, client, data):
+        self.sent += data
+
+    def can_write(self, client):
+        return self.writer
+
+    def configure_uart(self, **settings):
+        self.changes.append(settings)
+        self.config['uart'].update(settings)
+        return True
+
+
+def telnet(writer=True):
+    bridge = Bridge(writer)
+    return bridge, Telnet(bridge, Client())
+
+
+def com_port(command, value):
+    return bytes((IAC, SB, COM_PORT_OPTION, command)) + escape(value) + \
+        bytes((IAC, SE))
+
+
+def test_escape():
+    assert escape(b'a\xffb') == b'a\xff\xffb'
+    assert escape(memoryview(b'ab')) == b'ab'
+
+
+def test_data_and_escaped_iac():
+    bridge, tn = telnet()
+    tn.feed(b'ab\xff\xffcd')
+    assert bridge.input == b'ab\xffcd'
+    assert not bridge.commands and not bridge.sent
+
+
+def test_command_split_across_reads():
+    bridge, tn = telnet()
+    tn.feed(b'ab\xff')
+    tn.feed(bytes((BRK,)) + b'cd\xff')
+    tn.feed(b'\xff')
+    assert bridge.input == b'abcd\xff'
+    assert bridge.commands == [BRK]
+
+
+def test_negotiation():
+    bridge, tn = telnet()
+    tn.feed(bytes((IAC, WILL, COM_PORT_OPTION, IAC, DO, 99)))
+    # accepted, with the modem state, then refused
+    assert bridge.sent.startswith(bytes((IAC, DO, COM_PORT_OPTION, IAC, SB,
+                                         COM_PORT_OPTION, 107)))
+    assert bridge.sent.endswith(bytes((IAC, 252, 99)))
+    bridge.sent = bytearray()
+    tn.feed(bytes((IAC, WILL, COM_PORT_OPTION)))
+    assert not bridge.sent
+
+
+def test_subnegotiation_split_across_reads():
+    bridge, tn = telnet()
+    data = com_port(SET_BAUDRATE, (19200).to_bytes(4, 'big'))
+    for i in range(len(data)):
+        tn.feed(data[i:i + 1])
+    assert bridge.changes == [{'baudrate': 19200}]
+    assert bridge.sent == com_port(SET_BAUDRATE + 100,
+                                   (19200).to_bytes(4, 'big'))
+    assert not bridge.input
+
+
+def test_subnegotiation_escaped_value():
+    bridge, tn = telnet()
+    baudrate = 0x1feff
+    tn.feed(b'x' + com_port(SET_BAUDRATE, baudrate.to_bytes(4, 'big')) + b'y')
+    assert bridge.changes == [{'baudrate': baudrate}]
+    assert bridge.sent.count(b'\xff\xff') == 1
+    assert bridge.input == b'xy'
+
+
+def test_query_does_not_change():
+    bridge, tn = telnet()
+    tn.feed(com_port(SET_DATASIZE, b'\x00'))
+    assert not bridge.changes
+    assert bridge.sent == com_port(SET_DATASIZE + 100, b'\x08')
+
+
+def test_invalid_values_answered_with_current():
+    bridge, tn = telnet()
+    tn.feed(com_port(SET_DATASIZE, b'\x03'))
+    tn.feed(com_port(SET_PARITY, b'\x04'))
+    tn.feed(com_port(SET_BAUDRATE, b'\x01'))
+    assert not bridge.changes
+    assert bridge.sent == com_port(SET_DATASIZE + 100, b'\x08') + \
+        com_port(SET_PARITY + 100, b'\x01') + \
+        com_port(SET_BAUDRATE + 100, (9600).to_bytes(4, 'big'))
+
+
+def test_read_only_client():
+    bridge, tn = telnet(writer=False)
+    tn.feed(com_port(SET_DATASIZE, b'\x07'))
+    assert not bridge.changes
+    assert bridge.sent == com_port(SET_DATASIZE + 100, b'\x08')
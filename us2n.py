@@ -1,7 +1,9 @@
 # us2n.py
 
+import os
 import json
 import time
+import errno
 import select
 import socket
 import machine
@@ -10,9 +12,40 @@ import sys
 
 print_ = print
 VERBOSE = 1
+# usyslog.Logger print() also goes to, see S2NServer
+SYSLOG = None
 def print(*args, **kwargs):
     if VERBOSE:
         print_(*args, **kwargs)
+    if SYSLOG is not None:
+        SYSLOG.info(*args)
+
+
+def trace(*args):
+    # console only: data traces and configuration dumps stay off the syslog
+    if VERBOSE:
+        print_(*args)
+
+
+def redacted(config):
+    """Copy of a configuration with the passwords masked"""
+    if isinstance(config, dict):
+        return {key: '***' if key == 'password' else redacted(value)
+                for key, value in config.items()}
+    if isinstance(config, list):
+        return [redacted(item) for item in config]
+    return config
+
+
+try:
+    ticks_ms, ticks_diff = time.ticks_ms, time.ticks_diff
+except AttributeError:
+    # CPython
+    def ticks_ms():
+        return int(time.monotonic() * 1000)
+
+    def ticks_diff(a, b):
+        return a - b
 
 
 def read_config(filename='us2n.json', obj=None, default=None):
@@ -33,54 +66,245 @@ def parse_bind_address(addr, default=None):
     port = int(args[1])
     return host, port
 
+
+def file_key(filename, crc=False):
+    """[size, mtime] of a file, None if it is missing. Where the file
+    system keeps no mtime it is 0, or with crc the crc32 of the file (read
+    in small pieces)"""
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return None
+    if stat[8] or not crc:
+        return [stat[6], stat[8]]
+    import binascii
+    value = 0
+    buf = bytearray(256)
+    with open(filename, 'rb') as f:
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                return [stat[6], value]
+            value = binascii.crc32(memoryview(buf)[:n], value)
+
+
+def load_config(filename='us2n.json'):
+    """Validated configuration and the file_key(crc=True) of its file, to
+    tell when it changes. The file is read once: without mtime, the crc32
+    is that of the bytes parsed"""
+    stat = os.stat(filename)
+    if stat[8]:
+        config, key = read_config(filename), [stat[6], stat[8]]
+    else:
+        import binascii
+        with open(filename, 'rb') as f:
+            data = f.read()
+        config, key = json.loads(data), [stat[6], binascii.crc32(data)]
+    validate_config(config)
+    return config, key
+
+
+def validate_config(config):
+    """Raise ValueError naming the first unusable setting"""
+    def check(ok, where, message):
+        if not ok:
+            raise ValueError('configuration {0}: {1}'.format(where, message))
+
+    def check_object(section, where):
+        check(isinstance(section, dict), where, 'must be an object')
+
+    def check_address(section, where):
+        check_object(section, where)
+        try:
+            return parse_bind_address(section['bind'])
+        except (KeyError, IndexError, TypeError, ValueError, AttributeError):
+            check(False, where + '.bind', 'must be "<host>:<port>" or '
+                  '[<host>, <port>]')
+
+    def check_int(section, where, *keys):
+        for key in keys:
+            if key in section:
+                value = section[key]
+                check(isinstance(value, int) and not isinstance(value, bool)
+                      and value > 0,
+                      where + '.' + key, 'must be a positive integer')
+
+    check(isinstance(config, dict), 'file', 'must be a JSON object')
+    check(config.get('engine', 'poll') in ('poll', 'asyncio'), 'engine',
+          'must be "poll" or "asyncio"')
+    bridges = config.get('bridges')
+    check(isinstance(bridges, list) and bridges, 'bridges',
+          'must be a list of bridges')
+    ports = []
+    for i, bridge in enumerate(bridges):
+        where = 'bridges[{0}]'.format(i)
+        check_object(bridge, where)
+        for section in ('uart', 'auth', 'packet', 'ssl', 'capture', 'telnet',
+                        'lines'):
+            if section == 'uart' or section in bridge:
+                check_object(bridge.get(section), where + '.' + section)
+        check('port' in bridge['uart'], where + '.uart.port', 'missing')
+        check_int(bridge['uart'], where + '.uart', 'baudrate', 'bits',
+                  'stop', 'chunk', 'reads', 'ring_size')
+        check(bridge['uart'].get('parity') in (None, 0, 1),
+              where + '.uart.parity', 'must be null, 0 or 1')
+        check(bridge['uart'].get('bits', 8) in (5, 6, 7, 8, 9),
+              where + '.uart.bits', 'must be 5 to 9')
+        check(bridge['uart'].get('stop', 1) in (1, 2),
+              where + '.uart.stop', 'must be 1 or 2')
+        flow = bridge['uart'].get('flow', 0)
+        check(isinstance(flow, int) and not isinstance(flow, bool) and
+              flow >= 0, where + '.uart.flow', 'must be 0 or UART flags')
+        tcp = bridge.get('tcp')
+        for section in ('tcp', 'history'):
+            if section == 'tcp' or section in bridge:
+                address = check_address(bridge.get(section),
+                                        where + '.' + section)
+                check(address[1] not in ports, where + '.' + section,
+                      'port {0} used twice'.format(address[1]))
+                ports.append(address[1])
+        check_int(tcp, where + '.tcp', 'max_clients', 'queue_size')
+        if 'history' in bridge:
+            check_int(bridge['history'], where + '.history', 'max_clients')
+        check(tcp.get('write_mode', 'exclusive') in ('exclusive', 'shared'),
+              where + '.tcp.write_mode', 'must be "exclusive" or "shared"')
+        check(tcp.get('overflow', 'drop') in ('drop', 'disconnect'),
+              where + '.tcp.overflow', 'must be "drop" or "disconnect"')
+        if 'auth' in bridge:
+            check(isinstance(bridge['auth'].get('password'), str),
+                  where + '.auth.password', 'must be a string')
+        if 'packet' in bridge:
+            check_int(bridge['packet'], where + '.packet', 'size', 'timeout')
+            delimiter = bridge['packet'].get('delimiter')
+            check(delimiter is None or isinstance(delimiter, str),
+                  where + '.packet.delimiter', 'must be a string')
+        if 'ssl' in bridge:
+            for key in ('key', 'cert'):
+                check(key in bridge['ssl'], where + '.ssl.' + key, 'missing')
+        if 'capture' in bridge:
+            check('file' in bridge['capture'], where + '.capture.file',
+                  'missing')
+        for name, pin in bridge.get('lines', {}).items():
+            check(name in ('dtr', 'rts'), where + '.lines.' + name,
+                  'must be dtr or rts')
+            check(isinstance(pin, int) and not isinstance(pin, bool),
+                  where + '.lines.' + name, 'must be a pin number')
+    if 'stats' in config:
+        check_address(config['stats'], 'stats')
+    if 'control' in config:
+        address = check_address(config['control'], 'control')
+        check(address[1] not in ports, 'control',
+              'port {0} used twice'.format(address[1]))
+        if 'password' in config['control']:
+            check(isinstance(config['control']['password'], str),
+                  'control.password', 'must be a string')
+    for section in ('syslog', 'ntp'):
+        if section in config:
+            check_object(config[section], section)
+
 class RINGBUFFER:
-    def __init__(self, size):
-        self.data = bytearray(size)
+    """Byte ring buffer which overwrites the oldest data when full.
+
+    Besides the copying put()/get(), data can be moved without copies:
+    peek() returns a memoryview of the contiguous readable region which is
+    released with commit(n); reserve() returns a memoryview of the
+    contiguous writable region which is filled in with produce(n) (see
+    write_from()). buffer: the memory to use, ex: a slice of a Pool"""
+
+    def __init__(self, size, buffer=None):
+        self.data = bytearray(size) if buffer is None else buffer
+        self.view = memoryview(self.data)
         self.size = size
         self.index_put = 0
         self.index_get = 0
-        self.index_rewind = 0
-        self.wrapped = False
+        self.used = 0     # bytes not read yet
+        self.filled = 0   # bytes of history available to rewind()
+        self.dropped = 0  # bytes overwritten before being read
+        self.overflows = 0
+        # bytes ever written: the position of the next byte, for cursors
+        self.written = 0
+        # (timestamp, position) of the data kept, see mark()
+        self.marks = []
+
+    def __len__(self):
+        return self.used
+
+    def free(self):
+        return self.size - self.used
+
+    def has_data(self):
+        return self.used > 0
+
+    def clear(self):
+        self.index_put = self.index_get = self.used = self.filled = 0
+        self.dropped = self.overflows = 0
+
+    def reserve(self, numbytes=None):
+        end = self.size if numbytes is None else \
+            min(self.size, self.index_put + numbytes)
+        return self.view[self.index_put:end]
+
+    def produce(self, numbytes):
+        self.written += numbytes
+        self.index_put = (self.index_put + numbytes) % self.size
+        self.filled = min(self.size, self.filled + numbytes)
+        self.used += numbytes
+        # overflow: the oldest bytes were overwritten
+        if self.used > self.size:
+            lost = self.used - self.size
+            self.index_get = (self.index_get + lost) % self.size
+            self.used = self.size
+            self.dropped += lost
+            self.overflows += 1
+
+    def write_from(self, readinto, numbytes=None):
+        """Fill the buffer with readinto(memoryview) (ex: uart.readinto).
+        Returns the number of bytes read"""
+        numbytes = readinto(self.reserve(numbytes))
+        if numbytes:
+            self.produce(numbytes)
+        return numbytes or 0
 
     def put(self, data):
-        cur_idx = 0
-        while cur_idx < len(data):
-            min_idx = min(self.index_put+len(data)-cur_idx, self.size)
-            self.data[self.index_put:min_idx] = data[cur_idx:min_idx-self.index_put+cur_idx]
-            cur_idx += min_idx-self.index_put
-            if self.index_get > self.index_put:
-                self.index_get = max(min_idx+1, self.index_get)
-                if self.index_get >= self.size:
-                    self.index_get -= self.size
-            self.index_put = min_idx
-            if self.index_put == self.size:
-                self.index_put = 0
-                self.wrapped = True
-                if self.index_get == 0:
-                    self.index_get = 1
+        numbytes = len(data)
+        if numbytes > self.size:
+            # only the last size bytes would survive anyway
+            self.dropped += self.used + numbytes - self.size
+            self.overflows += 1
+            self.used = 0
+            self.index_get = self.index_put
+            data = memoryview(data)[numbytes - self.size:]
+            numbytes = self.size
+        elif not isinstance(data, memoryview):
+            data = memoryview(data)
+        start = 0
+        while start < numbytes:
+            region = self.reserve(numbytes - start)
+            n = len(region)
+            region[:] = data[start:start + n]
+            self.produce(n)
+            start += n
 
     def putc(self, value):
-        next_index = (self.index_put + 1) % self.size
         self.data[self.index_put] = value
-        self.index_put = next_index
-        # check for overflow
-        if self.index_get == self.index_put:
-            self.index_get = (self.index_get + 1) % self.size
+        self.produce(1)
         return value
 
+    def peek(self):
+        end = min(self.size, self.index_get + self.used)
+        return self.view[self.index_get:end]
+
+    def commit(self, numbytes):
+        self.index_get = (self.index_get + numbytes) % self.size
+        self.used -= numbytes
+
     def get(self, numbytes):
         data = bytearray()
-        while len(data) < numbytes:
-            start = self.index_get
-            min_idx = min(self.index_get+numbytes-len(data), self.size)
-            if self.index_put >= self.index_get:
-                min_idx = min(min_idx, self.index_put)
-            data.extend(self.data[start:min_idx])
-            self.index_get = min_idx
-            if self.index_get == self.size:
-                self.index_get = 0
-            if self.index_get == self.index_put:
-                break
+        while len(data) < numbytes and self.used:
+            region = self.peek()
+            n = min(len(region), numbytes - len(data))
+            data.extend(region[:n])
+            self.commit(n)
         return data
 
     def getc(self):
@@ -88,22 +312,164 @@ class RINGBUFFER:
             return None  ## buffer empty
         else:
             value = self.data[self.index_get]
-            self.index_get = (self.index_get + 1) % self.size
+            self.commit(1)
             return value
 
-    def has_data(self):
-        return self.index_get != self.index_put
-
     def rewind(self):
-        if self.wrapped:
-            self.index_get = (self.index_put+1) % self.size
-        else:
-            self.index_get = 0
+        # make all the history readable again
+        self.index_get = (self.index_put - self.filled) % self.size
+        self.used = self.filled
+
+    def ends_in(self, pattern, numbytes):
+        """True if pattern ends in the last numbytes written: it may start
+        before them, ex: a delimiter split across reads"""
+        numbytes = min(numbytes + len(pattern) - 1, self.filled)
+        start = (self.index_put - numbytes) % self.size
+        end = start + numbytes
+        first = self.view[start:min(self.size, end)]
+        second = self.view[:max(0, end - self.size)]
+        # copied for the search only if they have the last pattern byte
+        last = pattern[-1]
+        if last not in first and last not in second:
+            return False
+        return len(pattern) == 1 or pattern in bytes(first) + bytes(second)
+
+    def start(self):
+        # position of the oldest byte kept
+        return self.written - self.filled
+
+    def mark(self, timestamp, position):
+        """Note that the data from position on came at timestamp (one mark
+        per timestamp)"""
+        marks = self.marks
+        if marks and marks[-1][0] == timestamp:
+            return
+        marks.append((timestamp, position))
+        start = self.start()
+        while len(marks) > 1 and marks[1][1] <= start:
+            marks.pop(0)
+        if len(marks) > MAX_MARKS:
+            # coarser, not shorter: pairs merge into the timestamp of the
+            # second and the position of the first, which may give a bit
+            # more data than asked, never less
+            self.marks = [(marks[i + 1][0], marks[i][1])
+                          for i in range(0, len(marks) - 1, 2)]
+            if len(marks) % 2:
+                self.marks.append(marks[-1])
+
+    def position_since(self, timestamp):
+        """Position of the first byte kept which came at timestamp or
+        later"""
+        marks = self.marks
+        if marks and timestamp <= marks[0][0]:
+            return self.start()
+        for mark, position in marks:
+            if mark >= timestamp:
+                return max(position, self.start())
+        return self.written
+
+
+# marks kept by a RINGBUFFER
+MAX_MARKS = 256
+
+
+class Cursor:
+    """Reader of a RINGBUFFER with its own position, independent from the
+    ring buffer index_get and from the other cursors"""
+
+    def __init__(self, ring, position):
+        self.ring = ring
+        self.position = position
+        self.skipped = 0  # bytes overwritten before being read
+
+    def __len__(self):
+        ring = self.ring
+        return ring.written - max(self.position, ring.start())
+
+    def peek(self):
+        ring = self.ring
+        start = ring.start()
+        if self.position < start:
+            self.skipped += start - self.position
+            self.position = start
+        index = (ring.index_put - (ring.written - self.position)) % ring.size
+        end = index + ring.written - self.position
+        return ring.view[index:min(ring.size, end)]
+
+    def commit(self, numbytes):
+        self.position += numbytes
+
+
+class Pool:
+    """One allocation, made at startup while the heap is not fragmented
+    yet, which take() hands out in slices for the data path buffers"""
+
+    def __init__(self, size):
+        import gc
+        gc.collect()
+        self.view = memoryview(bytearray(size))
+        self.used = 0
+
+    def take(self, size):
+        if self.used + size > len(self.view):
+            raise MemoryError('buffer pool: {0} bytes left, {1} asked'
+                              .format(len(self.view) - self.used, size))
+        self.used += size
+        return self.view[self.used - size:self.used]
+
+
+# client input buffer of the poll engine, shared by its bridges
+RX_SIZE = 4096
+
+
+def ring_size(config):
+    return config['uart'].get('ring_size', 16 * 1024)
+
+
+def history_clients(config):
+    return config['history'].get('max_clients', 2) \
+        if 'history' in config else 0
+
+
+def buffer_size(config):
+    """Pool bytes a bridge takes: its ring buffer and a queue per client
+    and per history client"""
+    tcp = config['tcp']
+    return ring_size(config) + tcp.get('queue_size', 4096) * \
+        (tcp.get('max_clients', 1) + history_clients(config))
+
+
+def memory():
+    """Free heap and largest block which can be allocated (MicroPython)"""
+    import gc
+    if not hasattr(gc, 'mem_free'):
+        return {}
+    gc.collect()
+    free = gc.mem_free()
+    # a failed allocation collects and retries: no false MemoryError
+    low, high = 0, free
+    while low < high:
+        size = (low + high + 1) // 2
+        try:
+            block = bytearray(size)
+            del block
+            low = size
+        except MemoryError:
+            high = size - 1
+    gc.collect()
+    return dict(mem_free=free, mem_max_block=low)
+
+
+def uart_settings(config):
+    # the machine.UART init() arguments of a uart configuration
+    return {key: value for key, value in config.items()
+            if key not in ('type', 'port', 'chunk', 'reads', 'ring_size')}
+
 
 def UART(config):
-    config = dict(config)
-    uart_type = config.pop('type') if 'type' in config.keys() else 'hw'
-    port = config.pop('port')
+    uart_type = config.get('type', 'hw')
+    port = config['port']
+    config = uart_settings(config)
     if uart_type == 'SoftUART':
         print('Using SoftUART...')
         uart = machine.SoftUART(machine.Pin(config.pop('tx')),machine.Pin(config.pop('rx')),timeout=config.pop('timeout'),timeout_char=config.pop('timeout_char'),baudrate=config.pop('baudrate'))
@@ -114,9 +480,248 @@ def UART(config):
     return uart
 
 
+# errors meaning "try again later" on a non-blocking socket
+WOULDBLOCK = (errno.EAGAIN, getattr(errno, 'EWOULDBLOCK', errno.EAGAIN))
+
+
+def would_block(e):
+    # CPython SSL sockets raise SSLWantReadError/SSLWantWriteError instead
+    return e.args[0] in WOULDBLOCK or \
+        type(e).__name__ in ('SSLWantReadError', 'SSLWantWriteError')
+
+POLLIN, POLLOUT = select.POLLIN, select.POLLOUT
+POLLERR = select.POLLERR | select.POLLHUP
+
+
+class Poller:
+    """select.poll() with a dispatch table: objects are registered once
+    together with the handler(arg, event) to call when they are ready"""
+
+    def __init__(self):
+        self.poll = select.poll()
+        self.handlers = {}
+        # wakeups with something to do and the longest time (ms) spent
+        # handling one of them
+        self.wakeups = 0
+        self.max_busy = 0
+        # MicroPython reports the registered object, CPython its fileno
+        self.micropython = sys.implementation.name == 'micropython'
+
+    def key(self, obj):
+        return obj if self.micropython else obj.fileno()
+
+    def register(self, obj, handler, arg=None, events=POLLIN):
+        self.handlers[self.key(obj)] = handler, arg
+        self.poll.register(obj, events)
+
+    def modify(self, obj, events):
+        self.poll.modify(obj, events)
+
+    def unregister(self, obj):
+        self.handlers.pop(self.key(obj), None)
+        self.poll.unregister(obj)
+
+    def dispatch(self, timeout):
+        ipoll = getattr(self.poll, 'ipoll', self.poll.poll)
+        start = None
+        for entry in ipoll(timeout):
+            if start is None:
+                start = ticks_ms()
+            handler = self.handlers.get(entry[0])
+            # handler may be gone if a previous one closed its socket
+            if handler is not None:
+                handler[0](handler[1], entry[1])
+        if start is not None:
+            self.wakeups += 1
+            self.max_busy = max(self.max_busy, ticks_diff(ticks_ms(), start))
+
+
+class Client:
+
+    def __init__(self, sock, address, queue_size=4096, overflow='drop',
+                 queue=None):
+        self.sock = sock
+        self.address = address
+        self.state = 'listening'
+        self.menu_state = 'main'
+        self.menu_uart = None
+        self.password = bytearray()
+        # data waiting for the socket to become writable. overflow is
+        # the policy when it is full: 'drop' (drop oldest) or 'disconnect'.
+        # queue: a RINGBUFFER to reuse
+        self.queue = RINGBUFFER(queue_size) if queue is None else queue
+        self.overflow = overflow
+        self.events = POLLIN
+        self.telnet = None
+        self.tls = False
+        # Cursor of the UART history still to send, see Bridge.catch_up
+        self.cursor = None
+
+    @property
+    def dropped(self):
+        return self.queue.dropped
+
+    def has_output(self):
+        return self.queue.has_data()
+
+    def write(self, data):
+        try:
+            if hasattr(self.sock, 'send'):
+                return self.sock.send(data)
+            # SSL-wrapped sockets don't have send(), use write() instead.
+            # It returns None when it would block
+            return self.sock.write(data) or 0
+        except OSError as e:
+            if would_block(e):
+                return 0
+            raise
+
+    def send(self, data):
+        """Queue data and send as much as possible without blocking.
+        Returns False if the client should be disconnected"""
+        if self.sock is None:
+            return False
+        if isinstance(data, str):
+            data = data.encode()
+        if not self.queue.has_data():
+            # nothing queued: try to send straight from the caller's buffer
+            try:
+                n = self.write(data)
+            except OSError as e:
+                print('Client ', self.address, ' send error ', e)
+                return False
+            if n == len(data):
+                return True
+            if n:
+                data = memoryview(data)[n:]
+        if len(data) > self.queue.free() and self.overflow == 'disconnect':
+            print('Client ', self.address, ' too slow')
+            return False
+        self.queue.put(data)
+        return True
+
+    def flush(self):
+        """Send queued data until the socket would block.
+        Returns False if the client should be disconnected"""
+        queue = self.queue
+        try:
+            while queue.has_data():
+                n = self.write(queue.peek())
+                if not n:
+                    break
+                queue.commit(n)
+        except OSError as e:
+            print('Client ', self.address, ' send error ', e)
+            return False
+        return True
+
+    def buffered(self):
+        # SSL-wrapped sockets may hold decrypted data that poll does not
+        # report: they must be read until they would block
+        return self.tls
+
+    def recv_into(self, buf):
+        """Returns None if no data is available yet and 0 on EOF"""
+        try:
+            if hasattr(self.sock, 'recv_into'):
+                return self.sock.recv_into(buf)
+            # MicroPython sockets (SSL ones too) have readinto(), which
+            # returns None when it would block
+            return self.sock.readinto(buf)
+        except OSError as e:
+            if would_block(e):
+                return None
+            raise
+
+    def recv(self, n):
+        """Returns None if no data is available yet and b'' on EOF"""
+        try:
+            if hasattr(self.sock, 'recv'):
+                return self.sock.recv(n)
+            # SSL-wrapped sockets don't have recv(), use read() instead.
+            # Being non-blocking, it returns what the TLS layer has
+            # decrypted (up to n bytes) or None
+            return self.sock.read(n)
+        except OSError as e:
+            if would_block(e):
+                return None
+            raise
+
+    def close(self):
+        self.sock.close()
+        self.sock = None
+        self.state = 'listening'
+
+
+class HistoryClient(Client):
+    """Client of a history port: sends a request line and gets the part
+    of the UART history it asked for"""
+
+    def __init__(self, sock, address, queue):
+        super().__init__(sock, address, queue=queue)
+        self.state = 'history'
+        self.request = bytearray()
+
+
+# UART menu, opened with IAC IP: menu -> (title, uart setting, options)
+# with options (key, label, value). A value naming a menu opens it,
+# 'close' leaves the menu applying the changes
+MENUS = {
+    'main': ('UART parameters menu', None, (
+        ('a', 'Data bits: {bits}', 'databits'),
+        ('b', 'Baudrate: {baudrate}', 'baudrate'),
+        ('c', 'Parity: {parity}', 'parity'),
+        ('d', 'stop bits: {stop}', 'stop'),
+        ('e', 'exit', 'close'))),
+    'databits': ('databits parameters menu', 'bits', (
+        ('a', '7', 7), ('b', '8', 8), ('c', 'exit', 'main'))),
+    'baudrate': ('baudrate parameters menu', 'baudrate', (
+        ('a', '4800', 4800), ('b', '9600', 9600), ('c', '19200', 19200),
+        ('d', '38400', 38400), ('e', '57600', 57600),
+        ('f', '115200', 115200), ('z', 'exit', 'main'))),
+    'parity': ('parity parameters menu', 'parity', (
+        ('a', 'None', None), ('b', 'Even', 0), ('c', 'Odd', 1),
+        ('d', 'exit', 'main'))),
+    'stop': ('stop bit parameters menu', 'stop', (
+        ('a', '1', 1), ('b', '2', 2), ('c', 'exit', 'main'))),
+}
+PARITY_NAMES = {None: 'None', 0: 'Even', 1: 'Odd'}
+
+# built once: menu -> {key byte: value} and menu -> screen to format()
+MENU_KEYS, MENU_SCREENS = {}, {}
+for _menu, (_title, _setting, _options) in MENUS.items():
+    MENU_KEYS[_menu] = {ord(key): value for key, _, value in _options}
+    MENU_SCREENS[_menu] = '\033[2J{0}:\r\n{1}{2}please select an option: ' \
+        .format(_title, '' if _setting is None else
+                'actual -> {' + _setting + '}\r\n',
+                ''.join('{0}) {1}\r\n'.format(key, label)
+                        for key, label, _ in _options))
+
+# longest password kept while it is typed
+MAX_PASSWORD = 128
+
+# ms a client has to complete its TLS handshake
+HANDSHAKE_TIMEOUT = 5000
+
+HISTORY_USAGE = 'usage: last <bytes> | since <unix time | -seconds>\r\n'
+
+# seconds from 1970 to the epoch of time.time()
+EPOCH_OFFSET = 946684800 if time.gmtime(0)[0] == 2000 else 0
+
+
+def same_secret(given, secret):
+    """Compare in a time which depends on the length of given only, to
+    not tell how much of it is right"""
+    result = len(given) ^ len(secret)
+    secret = secret or b'\x00'
+    for i in range(len(given)):
+        result |= given[i] ^ secret[i % len(secret)]
+    return result == 0
+
+
 class Bridge:
 
-    def __init__(self, config):
+    def __init__(self, config, pool=None, rx=None):
         super().__init__()
         self.config = config
         self.uart = None
@@ -124,15 +729,102 @@ class Bridge:
         self.tcp = None
         self.address = parse_bind_address(config['tcp']['bind'])
         self.bind_port = self.address[1]
-        self.client = None
-        self.client_address = None
-        self.ring_buffer = RINGBUFFER(16 * 1024)
+        # max_clients: number of simultaneous clients. When full, the
+        # oldest client is dropped to make room for the new one.
+        # write_mode: 'exclusive' (only the oldest authenticated client
+        # writes to the UART) or 'shared' (every authenticated client does)
+        self.max_clients = config['tcp'].get('max_clients', 1)
+        self.write_mode = config['tcp'].get('write_mode', 'exclusive')
+        # queue_size: bytes buffered per client while its socket is not
+        # writable. overflow: 'drop' (oldest bytes) or 'disconnect'
+        self.queue_size = config['tcp'].get('queue_size', 4096)
+        self.overflow = config['tcp'].get('overflow', 'drop')
+        self.stats = dict(uart_rx=0, uart_tx=0, tcp_rx=0, tcp_tx=0,
+                          uart_reads=0, connects=0, auth_failures=0,
+                          max_queue=0, queue_dropped=0, history_tx=0)
+        self.clients = []
+        self.writer = None
+        self.poller = None
+        self.ssl = None
+        # TLS connections still in their handshake: [sock, address,
+        # ticks_ms() of the accept]
+        self.handshakes = []
+        self.first_accept = None
+        # set by the server: persists configuration changes
+        self.save_config = None
+        # history listener and its clients, which get the UART data of
+        # the past through their own cursor
+        self.history = None
+        self.history_clients = []
+        self.password = config['auth']['password'].encode() \
+            if 'auth' in config else None
+        # input stage of each client state
+        self.stages = {'enterpassword': self.auth_stage,
+                       'authenticated': self.passthrough_stage,
+                       'inMenu': self.menu_stage}
+        # buffers are taken once from pool (see buffer_size()): the UART
+        # ring buffer ("ring_size" under uart) and a queue per client,
+        # reused by the next clients. rx: client input buffer
+        if pool is None:
+            pool = Pool(buffer_size(config))
+        size = ring_size(config)
+        self.ring_buffer = RINGBUFFER(size, pool.take(size))
+        self.queues = [RINGBUFFER(self.queue_size, pool.take(self.queue_size))
+                       for _ in range(self.max_clients)]
+        # one per history client: more at once are refused
+        self.history_queues = [
+            RINGBUFFER(self.queue_size, pool.take(self.queue_size))
+            for _ in range(history_clients(config))]
+        self.rx = rx
         self.cur_line = bytearray()
-        self.state = 'listening'
-        self.menu_state = 'main'
         self.uart = UART(self.config['uart'])
+        # chunk: max bytes per UART read. reads: max reads per wakeup
+        # before going back to poll the other sources
+        self.chunk = config['uart'].get('chunk', 256)
+        self.reads = config['uart'].get('reads', 8)
+        self.uart_any = getattr(self.uart, 'any', None)
+        self.uart_readinto = getattr(self.uart, 'readinto', None)
+        # "packet": UART data is held until "size" bytes wait, a
+        # "delimiter" is read or the UART was idle for "timeout" ms.
+        # "nodelay" (under tcp) sends every read at once, with TCP_NODELAY
+        self.nodelay = config['tcp'].get('nodelay', False)
+        packet = config.get('packet')
+        self.packetize = packet is not None and not self.nodelay
+        if self.packetize:
+            delimiter = packet.get('delimiter')
+            self.delimiter = delimiter.encode() if delimiter else None
+            self.packet_size = min(packet.get('size', 1024),
+                                   self.ring_buffer.size // 2)
+            self.packet_timeout = packet.get('timeout', 50)
+        else:
+            self.delimiter = None
+        self.delimited = False
+        # ticks_ms() of the last UART read while data is held
+        self.held = None
+        # "telnet": {} parses telnet commands (and RFC 2217 unless
+        # "rfc2217" is false) and escapes IAC bytes. Without it clients
+        # get a raw byte pipe
+        self.telnet = None
+        if 'telnet' in config:
+            import us2n_telnet
+            self.telnet = us2n_telnet
+            self.rfc2217 = config['telnet'].get('rfc2217', True)
+        # "capture": {"file": <name>} records the traffic to a file, see
+        # us2ncap
+        self.capture = None
+        if 'capture' in config:
+            import us2ncap
+            self.capture = us2ncap.Capture(stats=self.stats,
+                                           **config['capture'])
+        # "lines": {"dtr": <pin>, "rts": <pin>} drives modem control lines
+        # on GPIOs, low when on like the outputs of USB serial adapters
+        self.lines = {name: machine.Pin(pin, machine.Pin.OUT, value=1)
+                      for name, pin in config.get('lines', {}).items()}
+        # raw clients may send IAC BRK/IP/AYT as a whole read. The server
+        # turns this off when it has a control port: data is never parsed
+        self.inband = True
         print('UART opened ', self.uart)
-        print(self.config)
+        trace(redacted(self.config))
 
     def bind(self):
         tcp = socket.socket()
@@ -144,315 +836,895 @@ class Bridge:
               .format(self.bind_port, self.uart_port))
         self.tcp = tcp
         if 'ssl' in self.config:
-            import ntptime
-            ntptime.host = "pool.ntp.org"
-            while True:
-                try:
-                    ntptime.settime()
-                except OSError as e:
-                    print(f"NTP synchronization failed, {e}")
-                    time.sleep(15)
-                    continue
-                print(f"NTP synchronization succeeded, {time.time()}")
-                print(time.gmtime())
-                break
-
+            self.load_ssl()
+        if self.poller is not None:
+            self.poller.register(tcp, self.handle_accept)
+        if 'history' in self.config:
+            self.bind_history()
         return tcp
 
-    def fill(self, fds):
-        if self.uart is not None:
-            fds.append(self.uart)
+    def bind_history(self):
+        # "history": {"bind": <address>} replays the UART history
+        address = parse_bind_address(self.config['history']['bind'])
+        sock = socket.socket()
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(address)
+        sock.listen(2)
+        self.history = sock
+        if self.poller is not None:
+            self.poller.register(sock, self.handle_history_accept)
+        print('History of UART({0}) at TCP({1})'.format(self.uart_port,
+                                                       address[1]))
+
+    def load_ssl(self):
+        """Read keys and certificates once, into an SSL context where the
+        port has one. Reusing the context lets clients resume sessions
+        where the TLS library supports it"""
+        try:
+            import ssl
+        except ImportError:
+            import ussl as ssl
+        sslconf = self.config['ssl']
+        if not hasattr(ssl, 'SSLContext'):
+            # older ports: keep the wrap_socket() arguments
+            sslconf = sslconf.copy()
+            for key in ['cadata', 'key', 'cert']:
+                if key in sslconf:
+                    with open(sslconf[key], "rb") as file:
+                        sslconf[key] = file.read()
+            # TODO: Setting CERT_REQUIRED produces MBEDTLS_ERR_X509_CERT_VERIFY_FAILED
+            sslconf['cert_reqs'] = ssl.CERT_OPTIONAL
+            self.ssl = sslconf
+            return
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(sslconf['cert'], sslconf['key'])
+        if 'cadata' in sslconf:
+            with open(sslconf['cadata'], 'rb') as file:
+                cadata = file.read()
+            # DER or PEM: CPython takes bytes as DER, PEM must be a str
+            if cadata.startswith(b'-----'):
+                cadata = cadata.decode()
+            context.load_verify_locations(cadata=cadata)
+        context.verify_mode = ssl.CERT_OPTIONAL
+        # number of session tickets (TLS 1.3 resumption) sent to clients
+        if 'tickets' in sslconf and hasattr(context, 'num_tickets'):
+            context.num_tickets = sslconf['tickets']
+        self.ssl = context
+
+    def wrap_socket(self, sock):
+        # the handshake is left to handshake(): here it would block
+        if isinstance(self.ssl, dict):
+            import ussl
+            return ussl.wrap_socket(sock, server_side=True, do_handshake=False,
+                                    **self.ssl)
+        return self.ssl.wrap_socket(sock, server_side=True,
+                                    do_handshake_on_connect=False)
+
+    def handshake(self, sock):
+        """Advance a TLS handshake without blocking. Returns 0 once it is
+        done, else the poll events it waits for"""
+        try:
+            if hasattr(sock, 'do_handshake'):
+                sock.do_handshake()
+            # MicroPython has no do_handshake(): the first read or write
+            # runs it, and write() returns None until it is done
+            elif sock.write(b'') is None:
+                return POLLIN
+            return 0
+        except OSError as e:
+            if type(e).__name__ == 'SSLWantWriteError':
+                return POLLOUT
+            if would_block(e):
+                return POLLIN
+            raise
+
+    def register(self, poller):
+        self.poller = poller
+        poller.register(self.uart, self.handle_uart)
         if self.tcp is not None:
-            fds.append(self.tcp)
-        if self.client is not None:
-            fds.append(self.client)
-        return fds
-
-    def recv(self, sock, n):
-        if hasattr(sock, 'recv'):
-            return sock.recv(n)
-        else:
-            # SSL-wrapped sockets don't have recv(), use read() instead
-            # TODO: Read more than 1 byte? Probably needs non-blocking sockets
-            return sock.read(1)
+            poller.register(self.tcp, self.handle_accept)
+        if self.history is not None:
+            poller.register(self.history, self.handle_history_accept)
+
+    def update_events(self, client):
+        # only ask for writability while there is something to write
+        events = POLLIN | POLLOUT if client.has_output() else POLLIN
+        if events != client.events:
+            client.events = events
+            self.poller.modify(client.sock, events)
 
-    def sendall(self, sock, bytes):
-        if hasattr(sock, 'sendall'):
-            return sock.sendall(bytes)
+    def send(self, client, data):
+        stats = self.stats
+        dropped = client.dropped
+        alive = client.send(data)
+        stats['tcp_tx'] += len(data)
+        stats['queue_dropped'] += client.dropped - dropped
+        if not alive:
+            self.close_client(client)
         else:
-            # SSL-wrapped sockets don't have sendall(), use write() instead
-            return sock.write(bytes)
-
-    def handle(self, fd):
-        if fd == self.tcp:
-            self.close_client()
-            self.open_client()
-        elif fd == self.client:
-            data = self.recv(self.client, 4096)
-            if data:
-                if self.state == 'enterpassword':
-                    while len(data):
-                        c = data[0:1]
-                        data = data[1:]
-                        if c == b'\n' or c == b'\r':
-                            print("Received password {0}".format(self.password))
-                            if self.password.decode('utf-8') == self.config['auth']['password']:
-                                self.sendall(self.client, "\r\nAuthentication succeeded\r\n")
-                                self.state = 'authenticated'
-                                self.ring_buffer.rewind()
-                                fd = self.uart # Send all uart data
-                                break
-                            else:
-                                self.password = b""
-                                self.sendall(self.client, "\r\nAuthentication failed\r\npassword: ")
-                        else:
-                                self.password += c
-                if self.state == 'authenticated':
-                    
-                    if data == b"\xff\xf3": #break
-                        self.uart.sendbreak()
-                        print('sending Break signal')
-                    elif data == b"\xff\xf6": #ayt
-                        self.sendall(self.client,"\r\nI'm here\r\n")
-                    elif data == b"\xff\xf4": #IP: interrupt process comes to a menu, maybe changing in future.
-                        self.state = "inMenu"
-                        self.menu_state = 'main'
-                        data=''
-                    else:
-                        print('TCP({0})->UART({1}) {2}'.format(self.bind_port,
-                                                           self.uart_port, data))
-                        self.uart.write(data)
-
-                if self.state == 'inMenu':
-                    #menu for changing uart parameters :)
-                    main_options = {b'a':'databits', b'b':'baudrate', b'c':'parity', b'd':'stop', b'e':'close'}
-                    databit_options = { b'a':7, b'b':8, b'c':'main'}
-                    baud_options={b'a':4800, b'b':9600, b'c':19200, b'd':38400, b'e':57600, b'f':115200, b'z':'main'}
-                    parity_options={b'a':'None', b'b':"Even", b'c':"Odd", b'd':'main'}
-                    stop_options = { b'a':1, b'b':2, b'c':'main'}
-                    
-                    def menutrace():
-                        print('self state: {0}, self.menustate: {1}, current config: {2} {3} {4}, curr vel: {5}, termdata: {6}'.format(self.state,self.menu_state,str(self.config['uart']['bits']),str(self.config['uart']['parity']),str(self.config['uart']['stop']),str(self.config['uart']['baudrate']),data))
-                    
-                    def mainMenu():
-                        menutrace()
-                        self.sendall(self.client,b'\033[2J'+
-                            "UART parameters menu:\r\n"+
-                            "a) Data bits: "+ str(self.config['uart']['bits'])+"\r\n"+
-                            "b) Baudrate: " + str(self.config['uart']['baudrate'])+"\r\n"+
-                            "c) Parity: " + str(self.config['uart']['parity'])+"\r\n"+
-                            "d) stop bits:" + str(self.config['uart']['stop'])+"\r\n"+
-                            "e) exit\r\n"+
-                            "please select an option: ")
-                        
-                    def dataBitMenu():
-                        menutrace()
-                        self.sendall(self.client,b'\033[2J'+
-                            "databits parameters menu:\r\n"+
-                            "actual -> "+str(self.config['uart']['bits'])+"\r\n"+
-                            "a) 7 \r\n"+
-                            "b) 8 \r\n"+
-                            "c) exit\r\n"+
-                            "please select an option: ")
-                        
-                    def baudMenu():
-                        menutrace()
-                        self.sendall(self.client,b'\033[2J'+
-                            "baudrate parameters menu:\r\n"+
-                            "actual -> "+str(self.config['uart']['baudrate'])+"\r\n"+
-                            "a) 4800 \r\n"+
-                            "b) 9600 \r\n"+
-                            "c) 19200 \r\n"+
-                            "d) 38400\r\n"+
-                            "e) 57600\r\n"+
-                            "z) exit"+
-                            "please select an option: ")
-
-                    def parityMenu():
-                        menutrace()
-                        self.sendall(self.client,b'\033[2J'+
-                            "parity parameters menu:\r\n"+
-                            "actual -> "+str(self.config['uart']['parity'])+"\r\n"+
-                            "a) None \r\n"+
-                            "b) Even \r\n"+
-                            "c) Odd \r\n"+
-                            "d) exit\r\n"+
-                            "please select an option: ")
-
-                    def stopMenu():
-                        menutrace()
-                        self.sendall(self.client,b'\033[2J'+
-                            "stop bit parameters menu:\r\n"+
-                            "actual -> "+str(self.config['uart']['stop'])+"\r\n"+
-                            "a) 1 \r\n"+
-                            "b) 2 \r\n"+
-                            "c) exit\r\n"+
-                            "please select an option: ")    
-                        
-                    if self.menu_state=='main':
-                        if data==b'':
-                            mainMenu()
-                        else:
-                            try:
-                                self.menu_state = main_options[data]
-                                data=b''
-                            except:
-                                mainMenu() 
-
-                    if self.menu_state=='databits':
-                        if data==b'':
-                            dataBitMenu()
-                        else:
-                            try:
-                                if databit_options[data] != 'main':
-                                    self.config['uart']['bits']=databit_options[data]
-                                    dataBitMenu()
-                                else:
-                                    self.menu_state=databit_options[data]
-                                    mainMenu()
-                            except:
-                                dataBitMenu()
-
-                    if self.menu_state=='baudrate':
-                        if data==b'':
-                            baudMenu()
-                        else:
-                            try:
-                                if baud_options[data] != 'main':
-                                    self.config['uart']['baudrate']=baud_options[data]
-                                    baudMenu()
-                                else:
-                                    self.menu_state=baud_options[data]
-                                    mainMenu()
-                            except:
-                                baudMenu()
-
-                    if self.menu_state=='parity':
-                        if data==b'':
-                            parityMenu()
-                        else:
-                            try:
-                                if parity_options[data] != 'main':
-                                    self.config['uart']['parity']=parity_options[data]
-                                    parityMenu()
-                                else:
-                                    self.menu_state=parity_options[data]
-                                    mainMenu()
-                            except:
-                                parityMenu()
-                    
-                    if self.menu_state=='stop':
-                        if data==b'':
-                            stopMenu()
-                        else:
-                            try:
-                                if stop_options[data] != 'main':
-                                    self.config['uart']['stop']=stop_options[data]
-                                    stopMenu()
-                                else:
-                                    self.menu_state=databit_options[data]
-                                    mainMenu()
-                            except:
-                                stopMenu()        
-                    
-                    if self.menu_state=='close':
-                        menutrace()
-                        self.sendall(self.client,b'\033[2J')
-                        #if new changes, save new data to config file
-                        with open('us2n.json','r') as f:
-                            excnf=json.loads(f.read())
-                        for item in excnf['bridges']:
-                            if item not in self.config:
-                                print("found a new configuration {0}, resetting...".format(item))
-                                with open('us2n.json','w') as f:
-                                    excnf['bridges']=self.config
-                                    json.dump(excnf,f)
-                                #reset uart
-                                #here is a problem i cant debug, making a soft reset
-                                sys.exit()
-                        #if not changes where made we go back to terminal.                        
-                        self.menu_state = 'main'
-                        self.state = 'authenticated'
-                        data=b''
+            stats['max_queue'] = max(stats['max_queue'], len(client.queue))
+            self.update_events(client)
+        return alive
+
+    def get_stats(self):
+        stats = dict(self.stats)
+        stats['port'] = self.bind_port
+        stats['clients'] = len(self.clients)
+        stats['ring_overflows'] = self.ring_buffer.overflows
+        stats['ring_dropped'] = self.ring_buffer.dropped
+        return stats
+
+    def tick(self):
+        # retry output that may be stuck in an SSL layer which does not
+        # report writability
+        for client in list(self.clients):
+            if client.has_output():
+                self.handle_write(client)
+        now = ticks_ms()
+        for entry in list(self.handshakes):
+            if ticks_diff(now, entry[2]) >= HANDSHAKE_TIMEOUT:
+                print('Client ', entry[1], ' TLS handshake timed out')
+                self.close_handshake(entry)
+        if self.capture is not None:
+            self.capture.tick()
+
+    def set_line(self, name, on):
+        """Set a modem control line. False if it has no pin"""
+        pin = self.lines.get(name)
+        if pin is None:
+            return False
+        pin.value(0 if on else 1)
+        return True
+
+    def line_on(self, name):
+        # None if the line has no pin
+        pin = self.lines.get(name)
+        return None if pin is None else not pin.value()
+
+    def can_write(self, client):
+        if self.write_mode == 'shared':
+            return True
+        if self.writer is None:
+            self.writer = client
+        return self.writer is client
+
+    def authenticated(self):
+        return [client for client in self.clients
+                if client.state == 'authenticated']
+
+    def handle_accept(self, _, event):
+        if event & POLLERR:
+            raise OSError('error on TCP server {0}'.format(self.address))
+        self.open_client()
+
+    def handle_socket(self, client, event):
+        if event & POLLERR:
+            print('Client ', client.address, ' hung up')
+            self.close_client(client)
+            return
+        if event & POLLOUT:
+            self.handle_write(client)
+        if event & POLLIN and client.sock is not None:
+            self.handle_client(client)
+
+    def handle_uart(self, _, event):
+        if event & POLLIN:
+            for _ in range(self.reads):
+                if not self.read_uart():
+                    break
+                if self.nodelay:
+                    self.send_uart()
+            if self.packetize:
+                self.hold_uart()
             else:
-                print('Client ', self.client_address, ' disconnected')
-                self.close_client()
-        if fd == self.uart:
-            data = self.uart.read(64)
-            if data is not None:
+                self.send_uart()
+
+    def send_uart(self):
+        self.held = None
+        self.delimited = False
+        # clients catching up on the history get this data from their cursor
+        clients = [client for client in self.authenticated()
+                   if client.cursor is None]
+        if clients:
+            self.send_ring(clients)
+
+    def hold_uart(self):
+        # send the UART data once a packet is complete
+        ring = self.ring_buffer
+        if not ring.has_data():
+            return
+        if self.delimited or len(ring) >= self.packet_size:
+            self.send_uart()
+        else:
+            self.held = ticks_ms()
+
+    def packet_wait(self, now):
+        """ms before the held UART data is due, None if none is held"""
+        if self.held is None:
+            return None
+        return max(0, self.packet_timeout - ticks_diff(now, self.held))
+
+    def flush_held(self, now):
+        if self.held is not None and \
+           ticks_diff(now, self.held) >= self.packet_timeout:
+            self.send_uart()
+
+    def check_delimiter(self, n):
+        # n bytes were just read into the ring buffer
+        if self.delimiter is not None and \
+           self.ring_buffer.ends_in(self.delimiter, n):
+            self.delimited = True
+
+    def read_uart(self):
+        # read what the UART has (up to chunk bytes) straight into the
+        # ring buffer. Returns the number of bytes read
+        n = self.uart_any() if self.uart_any is not None else self.chunk
+        if not n:
+            return 0
+        n = min(n, self.chunk)
+        if self.uart_readinto is not None:
+            n = self.ring_buffer.write_from(self.uart_readinto, n)
+        else:
+            data = self.uart.read(n)
+            n = len(data) if data else 0
+            if n:
                 self.ring_buffer.put(data)
-            if self.state == 'authenticated' and self.ring_buffer.has_data():
-                data = self.ring_buffer.get(4096)
-                print('UART({0})->TCP({1}) {2}'.format(self.uart_port,
-                                                       self.bind_port, data))
-                self.sendall(self.client, data)
-
-    def close_client(self):
-        if self.client is not None:
-            print('Closing client ', self.client_address)
-            self.client.close()
-            self.client = None
-            self.client_address = None
-        self.state = 'listening'
+        if n:
+            self.check_delimiter(n)
+        self.uart_received(n)
+        return n
+
+    def uart_received(self, n):
+        self.stats['uart_reads'] += 1
+        self.stats['uart_rx'] += n
+        if n:
+            ring = self.ring_buffer
+            ring.mark(int(time.time()), ring.written - n)
+            if self.capture is not None:
+                # the n bytes read may wrap around the ring buffer
+                index = (ring.index_put - n) % ring.size
+                end = min(ring.size, index + n)
+                self.capture.from_serial(ring.view[index:end])
+                if end - index < n:
+                    self.capture.from_serial(ring.view[:n - end + index])
+
+    def send_ring(self, clients):
+        # send the unread part of the ring buffer without copying it
+        ring = self.ring_buffer
+        while ring.has_data():
+            data = ring.peek()
+            if VERBOSE:
+                trace('UART({0})->TCP({1}) {2}'.format(
+                    self.uart_port, self.bind_port, bytes(data)))
+            escaped = None
+            for client in clients:
+                if client.telnet is None:
+                    self.send(client, data)
+                else:
+                    if escaped is None:
+                        escaped = self.telnet.escape(data)
+                    self.send(client, escaped)
+            ring.commit(len(data))
+
+    def handle_write(self, client):
+        if not client.flush():
+            self.close_client(client)
+        elif client.cursor is not None:
+            self.catch_up(client)
+        else:
+            self.update_events(client)
+
+    def catch_up(self, client):
+        # send the history to a new client as its queue takes it, up to
+        # the data the other clients got: then it gets data with them
+        cursor, queue = client.cursor, client.queue
+        ring = self.ring_buffer
+        if not [other for other in self.authenticated()
+                if other.cursor is None]:
+            # no other client is owed the data not sent yet: it is part
+            # of what this one catches up on
+            ring.commit(len(ring))
+        # telnet escaping may double the data
+        scale = 1 if client.telnet is None else 2
+        while True:
+            data = cursor.peek()
+            n = min(len(data), queue.free() // scale,
+                    ring.written - len(ring) - cursor.position)
+            if n <= 0:
+                break
+            data = data[:n]
+            if client.telnet is not None:
+                data = self.telnet.escape(data)
+            if not self.send(client, data):
+                return
+            cursor.commit(n)
+        if cursor.position >= ring.written - len(ring):
+            client.cursor = None
+        self.update_events(client)
+
+    def handle_client(self, client):
+        buffered = client.buffered()
+        if self.rx is None:
+            self.rx = memoryview(bytearray(RX_SIZE))
+        rx = self.rx
+        while client.sock is not None:
+            n = client.recv_into(rx)
+            if n is None:
+                return
+            if not n:
+                print('Client ', client.address, ' disconnected')
+                self.close_client(client)
+                return
+            self.handle_data(client, rx[:n])
+            if not buffered:
+                return
+
+    def handle_data(self, client, data):
+        self.stats['tcp_rx'] += len(data)
+        if not self.inband and client.telnet is None and \
+           client.state == 'authenticated':
+            # pure byte pipe
+            self.write_uart(client, data)
+            return
+        if isinstance(data, memoryview) and \
+           (client.telnet is not None or client.state != 'authenticated'):
+            # parsed with find(), which memoryviews lack
+            data = bytes(data)
+        if client.telnet is not None:
+            # plain data comes back through handle_input()
+            client.telnet.feed(data)
+        else:
+            self.handle_input(client, data, 0, len(data))
+
+    def handle_input(self, client, data, start, end):
+        """Run data[start:end] through the stage of the client state.
+        Stages return where they stopped: the rest goes to the stage of
+        the new state"""
+        while start < end:
+            stage = self.stages.get(client.state)
+            if stage is None:
+                return
+            start = stage(client, data, start, end)
+
+    def auth_stage(self, client, data, start, end):
+        # the password ends with CR or LF
+        cr = data.find(b'\r', start, end)
+        lf = data.find(b'\n', start, end)
+        stop = cr if lf < 0 or 0 <= cr < lf else lf
+        password = client.password
+        if len(password) < MAX_PASSWORD:
+            password.extend(memoryview(data)[start:end if stop < 0 else stop])
+        if stop < 0:
+            return end
+        client.password = bytearray()
+        if same_secret(password, self.password):
+            print("Authentication succeeded")
+            self.send(client, "\r\nAuthentication succeeded\r\n")
+            self.authenticate(client)
+        else:
+            print("Authentication failed")
+            self.stats['auth_failures'] += 1
+            self.send(client, "\r\nAuthentication failed\r\npassword: ")
+        stop += 1
+        # skip the LF (or the NUL of telnet clients) after a CR
+        if stop < end and data[stop - 1] == 13 and data[stop] in (0, 10):
+            stop += 1
+        return stop
+
+    def passthrough_stage(self, client, data, start, end):
+        if client.telnet is None and self.inband and end - start == 2 and \
+           data[start] == 0xff and data[start + 1] in (0xf3, 0xf4, 0xf6):
+            # raw mode: only whole reads are taken as commands
+            self.telnet_command(client, data[start + 1])
+        elif start == 0 and end == len(data):
+            self.write_uart(client, data)
+        else:
+            self.write_uart(client, memoryview(data)[start:end])
+        return end
+
+    def menu_stage(self, client, data, start, end):
+        # one key at a time: each one may change the menu
+        menu = client.menu_state
+        key = data[start]
+        keys = MENU_KEYS[menu]
+        if key not in keys:
+            if key not in (0, 10, 13):
+                self.show_menu(client)
+            return start + 1
+        value = keys[key]
+        if value == 'close':
+            self.close_menu(client)
+        elif isinstance(value, str):
+            client.menu_state = value
+            self.show_menu(client)
+        else:
+            client.menu_uart[MENUS[menu][1]] = value
+            self.show_menu(client)
+        return start + 1
+
+    def show_menu(self, client):
+        uart = client.menu_uart
+        self.send(client, MENU_SCREENS[client.menu_state].format(
+            bits=uart.get('bits'), baudrate=uart.get('baudrate'),
+            parity=PARITY_NAMES.get(uart.get('parity')),
+            stop=uart.get('stop')))
+
+    def open_menu(self, client):
+        client.state = 'inMenu'
+        client.menu_state = 'main'
+        # edited by the menu, applied when leaving it
+        client.menu_uart = dict(self.config['uart'])
+        self.show_menu(client)
+
+    def close_menu(self, client):
+        self.send(client, '\033[2J')
+        # if new changes, apply them to this UART only and save them
+        uart = self.config['uart']
+        changes = {key: value for key, value in client.menu_uart.items()
+                   if uart.get(key) != value}
+        if changes:
+            print("found a new configuration {0}".format(changes))
+            if not self.configure_uart(**changes):
+                self.send(client, "UART settings refused\r\n")
+            elif self.save_config is not None:
+                self.save_config()
+        client.menu_uart = None
+        client.menu_state = 'main'
+        client.state = 'authenticated'
+
+    def write_uart(self, client, data):
+        if not self.can_write(client):
+            print('TCP({0}) read-only client {1} ignored'.format(
+                self.bind_port, client.address))
+            return
+        if VERBOSE:
+            trace('TCP({0})->UART({1}) {2}'.format(self.bind_port,
+                                                   self.uart_port, bytes(data)))
+        self.uart.write(data)
+        self.stats['uart_tx'] += len(data)
+        if self.capture is not None:
+            self.capture.to_serial(data)
+
+    def telnet_command(self, client, command):
+        # handle a telnet command (the byte after IAC)
+        if command == 0xf6: #ayt
+            self.send(client, "\r\nI'm here\r\n")
+        elif client.state != 'authenticated':
+            pass
+        elif not self.can_write(client):
+            print('TCP({0}) read-only client {1} ignored'.format(
+                self.bind_port, client.address))
+        elif command == 0xf3: #break
+            self.uart.sendbreak()
+            print('sending Break signal')
+        elif command == 0xf4: #IP: interrupt process comes to a menu
+            self.open_menu(client)
+
+    def configure_uart(self, **settings):
+        """Apply new UART settings (machine.UART init() arguments). The
+        previous ones are restored if the port refuses them, whatever it
+        raises (TypeError for an argument it does not know)"""
+        config = self.config['uart']
+        previous = dict(config)
+        config.update(settings)
+        print('UART({0}) settings {1}'.format(self.uart_port, settings))
+        try:
+            self.uart.init(**uart_settings(config))
+            return True
+        except Exception as e:
+            print('UART({0}) refused {1}: {2}'.format(self.uart_port,
+                                                   settings, e))
+            config.clear()
+            config.update(previous)
+            self.uart.init(**uart_settings(config))
+            return False
+
+    def authenticate(self, client, rewind=True):
+        client.state = 'authenticated'
+        if self.write_mode == 'exclusive' and self.writer is None:
+            self.writer = client
+        # the UART history (rewind) or the data nobody got yet goes to
+        # the newcomer from POLLOUT (see catch_up): all at once it would
+        # overflow its queue
+        ring = self.ring_buffer
+        client.cursor = Cursor(ring, ring.start() if rewind
+                               else ring.written - len(ring))
+        self.catch_up(client)
+
+    def close_client(self, client):
+        if client not in self.clients:
+            return
+        print('Closing client ', client.address)
+        self.clients.remove(client)
+        if self.poller is not None:
+            self.poller.unregister(client.sock)
+        client.close()
+        client.queue.clear()
+        self.queues.append(client.queue)
+        if self.writer is client:
+            authenticated = self.authenticated()
+            self.writer = authenticated[0] if authenticated else None
+
+    def make_room(self):
+        if len(self.clients) >= self.max_clients:
+            self.close_client(self.clients[0])
 
     def open_client(self):
-        self.client, self.client_address = self.tcp.accept()
-        print('Accepted connection from ', self.client_address)
-        if 'ssl' in self.config:
-            import ussl
-            import ubinascii
-            print(time.gmtime())
-            sslconf = self.config['ssl'].copy()
-            for key in ['cadata', 'key', 'cert']:
-                if key in sslconf:
-                    with open(sslconf[key], "rb") as file:
-                        sslconf[key] = file.read()
-            # TODO: Setting CERT_REQUIRED produces MBEDTLS_ERR_X509_CERT_VERIFY_FAILED
-            sslconf['cert_reqs'] = ussl.CERT_OPTIONAL
-            self.client = ussl.wrap_socket(self.client, server_side=True, **sslconf)
-        self.state = 'enterpassword' if 'auth' in self.config else 'authenticated'
-        self.password = b""
-        if self.state == 'enterpassword':
-            self.sendall(self.client, "password: ")
+        sock, address = self.tcp.accept()
+        print('Accepted connection from ', address)
+        if self.nodelay:
+            self.set_nodelay(sock)
+        # an SSL layer above a non-blocking socket is non-blocking too
+        sock.setblocking(False)
+        if self.ssl is None:
+            return self.connect_client(sock, address)
+        try:
+            sock = self.wrap_socket(sock)
+        except OSError as e:
+            print('Client ', address, ' TLS error ', e)
+            sock.close()
+            return None
+        # the handshake runs from the poll loop, to HANDSHAKE_TIMEOUT
+        if len(self.handshakes) >= self.max_clients:
+            self.close_handshake(self.handshakes[0])
+        entry = [sock, address, ticks_ms()]
+        self.handshakes.append(entry)
+        self.poller.register(sock, self.handle_handshake, entry)
+        self.handle_handshake(entry, POLLIN)
+
+    def handle_handshake(self, entry, event):
+        sock, address, _ = entry
+        try:
+            if event & POLLERR:
+                raise OSError('hung up')
+            events = self.handshake(sock)
+        except OSError as e:
+            print('Client ', address, ' TLS handshake failed ', e)
+            self.close_handshake(entry)
+            return
+        if events:
+            self.poller.modify(sock, events)
+            return
+        self.handshakes.remove(entry)
+        self.poller.unregister(sock)
+        self.connect_client(sock, address, tls=True)
+
+    def close_handshake(self, entry):
+        if entry in self.handshakes:
+            self.handshakes.remove(entry)
+            self.poller.unregister(entry[0])
+            entry[0].close()
+
+    def connect_client(self, sock, address, tls=False):
+        # only for a usable connection: it may cost the oldest client
+        self.make_room()
+        client = Client(sock, address, self.queue_size, self.overflow,
+                        self.queues.pop())
+        client.tls = tls
+        self.poller.register(sock, self.handle_socket, client)
+        self.add_client(client)
+        return client
+
+    def set_nodelay(self, sock):
+        if hasattr(socket, 'TCP_NODELAY'):
+            try:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            except OSError as e:
+                print('TCP_NODELAY not set: {0}'.format(e))
+
+    def add_client(self, client):
+        self.clients.append(client)
+        self.stats['connects'] += 1
+        if self.telnet is not None:
+            client.telnet = self.telnet.Telnet(self, client, self.rfc2217)
+        if self.first_accept is None:
+            self.first_accept = ticks_ms()
+        if 'auth' in self.config:
+            client.state = 'enterpassword'
+            self.send(client, "password: ")
             print("Prompting for password")
+        else:
+            self.authenticate(client, rewind=False)
+
+    def handle_history_accept(self, _, event):
+        sock, address = self.history.accept()
+        if not self.history_queues:
+            print('History client ', address, ' refused: too many')
+            sock.close()
+            return
+        sock.setblocking(False)
+        client = HistoryClient(sock, address, self.history_queues.pop())
+        self.history_clients.append(client)
+        self.poller.register(sock, self.handle_history, client)
+
+    def handle_history(self, client, event):
+        if event & POLLERR:
+            self.close_history(client)
+            return
+        if event & POLLOUT and not client.flush():
+            self.close_history(client)
+            return
+        if event & POLLIN and client.cursor is None:
+            try:
+                data = client.recv(64)
+            except OSError:
+                self.close_history(client)
+                return
+            if data is None:
+                return
+            request = client.request
+            request.extend(data)
+            if not data or b'\n' in data or len(request) >= 64:
+                client.cursor = self.history_cursor(request)
+                if client.cursor is None:
+                    client.send(HISTORY_USAGE)
+                    self.close_history(client)
+                    return
+        if client.cursor is not None:
+            self.replay(client)
+
+    def history_cursor(self, request):
+        """Cursor from a history request: "last <bytes>", "since <unix
+        time>" (negative: seconds ago) or nothing, for all of it"""
+        ring = self.ring_buffer
+        words = bytes(request).split()
+        try:
+            if not words:
+                return Cursor(ring, ring.start())
+            number = int(words[1])
+            if words[0] == b'last':
+                return Cursor(ring, max(ring.start(), ring.written - number))
+            if words[0] == b'since':
+                if number < 0:
+                    number += time.time()
+                else:
+                    number -= EPOCH_OFFSET
+                return Cursor(ring, ring.position_since(number))
+        except (IndexError, ValueError):
+            pass
+
+    def replay(self, client):
+        # move history to the client as it takes it, close when done
+        cursor, queue = client.cursor, client.queue
+        while queue.free():
+            data = cursor.peek()
+            if not len(data):
+                break
+            data = data[:queue.free()]
+            if not client.send(data):
+                self.close_history(client)
+                return
+            cursor.commit(len(data))
+            self.stats['history_tx'] += len(data)
+        if not client.has_output() and not len(cursor):
+            self.close_history(client)
+        elif client.events != POLLOUT:
+            # the request is read: input (or EOF) no longer wakes us up
+            client.events = POLLOUT
+            self.poller.modify(client.sock, POLLOUT)
+
+    def close_history(self, client):
+        if client in self.history_clients:
+            self.history_clients.remove(client)
+            self.poller.unregister(client.sock)
+            client.close()
+            client.queue.clear()
+            self.history_queues.append(client.queue)
 
     def close(self):
-        self.close_client()
+        for client in list(self.clients):
+            self.close_client(client)
+        for entry in list(self.handshakes):
+            self.close_handshake(entry)
+        for client in list(self.history_clients):
+            self.close_history(client)
+        if self.poller is not None:
+            if self.tcp is not None:
+                self.poller.unregister(self.tcp)
+            if self.history is not None:
+                self.poller.unregister(self.history)
+            self.poller.unregister(self.uart)
+            self.poller = None
+        if self.history is not None:
+            self.history.close()
+            self.history = None
         if self.tcp is not None:
             print('Closing TCP server {0}...'.format(self.address))
             self.tcp.close()
             self.tcp = None
+        if self.capture is not None:
+            self.capture.close()
+
+
+class ConfigChanged(Exception):
+    """The configuration file changed: serve it"""
+
+
+# ms between two reads of a configuration file without mtime, see
+# S2NServer.check_config
+CONFIG_CRC_MS = 60000
+
+# longest wait (ms) between two DNS queries of a Lookup
+MAX_LOOKUP_WAIT = 300000
+
+
+def numeric(host):
+    # a dotted IPv4 address, which getaddrinfo() converts without DNS
+    parts = host.split('.')
+    return len(parts) == 4 and all(part.isdigit() for part in parts)
 
 
 class S2NServer:
 
-    def __init__(self, config):
+    def __init__(self, config, filename='us2n.json', key=None):
         self.config = config
+        self.filename = filename
+        # file_key() of the configuration file, watched for changes (every
+        # tick) unless "reload" is false
+        self.config_key = key if config.get('reload', True) else None
+        # ticks_ms() of the last crc32 of a file without mtime
+        self.crc_checked = ticks_ms()
+        self.bridges = []
+        self.pool = None
+        self.poller = None
+        self.stats_server = None
+        self.control = None
+        self.start = ticks_ms()
+        self.network = Network(config.get('wlan'), config.get('name'))
+        # certificates validity checks need the right time
+        self.time_sync = None
+        if any('ssl' in bridge for bridge in config['bridges']):
+            self.time_sync = TimeSync(**config.get('ntp', {}))
+        # bridges waiting for their interface (and time, for SSL) to listen
+        self.pending = []
+        self.first_accept = None
+        # host name -> Lookup, see resolve_hosts
+        self.lookups = {}
+        # "syslog": print() and exceptions also go to a syslog server, even
+        # when local output is off
+        global SYSLOG
+        self.syslog = SYSLOG = None
+        if 'syslog' in config:
+            import usyslog
+            settings = dict(config['syslog'])
+            settings.setdefault('hostname', config.get('name') or '-')
+            self.syslog = SYSLOG = usyslog.Logger(**settings)
+
+    def get_stats(self):
+        stats = dict(name=self.config.get('name'),
+                     uptime=ticks_diff(ticks_ms(), self.start) // 1000,
+                     bridges=[bridge.get_stats() for bridge in self.bridges])
+        if self.poller is not None:
+            stats['wakeups'] = self.poller.wakeups
+            stats['max_busy_ms'] = self.poller.max_busy
+        if self.syslog is not None:
+            stats['syslog_sent'] = self.syslog.sent
+            stats['syslog_dropped'] = self.syslog.dropped
+        if self.pool is not None:
+            stats['pool_size'] = len(self.pool.view)
+        stats.update(memory())
+        stats.update(self.boot_times())
+        return stats
+
+    def boot_times(self):
+        """ms from start to network up, time synced and first accept"""
+        accepts = [bridge.first_accept for bridge in self.bridges
+                   if bridge.first_accept is not None]
+        if self.first_accept is None and accepts:
+            self.first_accept = min(accepts, key=lambda t: ticks_diff(t, self.start))
+            print('First connection accepted after {0} ms'
+                  .format(ticks_diff(self.first_accept, self.start)))
+        times = dict(network_up_ms=self.network.up,
+                     first_accept_ms=self.first_accept)
+        if self.time_sync is not None:
+            times['time_synced_ms'] = self.time_sync.synced
+        return {key: ticks_diff(t, self.start)
+                for key, t in times.items() if t is not None}
+
+    def bring_up(self):
+        """Advance the network bring-up and NTP sync. Returns the pending
+        bridges which can listen now"""
+        network = self.network
+        network.tick()
+        if network.ready():
+            self.resolve_hosts()
+        synced = self.time_sync is None or \
+            (network.ready() and self.time_sync.tick())
+        ready = [bridge for bridge in self.pending
+                 if network.ready(bridge.address[0]) and
+                 (synced or 'ssl' not in bridge.config)]
+        for bridge in ready:
+            self.pending.remove(bridge)
+        return ready
+
+    def resolve_hosts(self, blocking=False):
+        """Look the NTP and syslog hosts up, without blocking: names are
+        asked to the DNS server of the WLAN station (see Lookup), numeric
+        addresses need no DNS. Without a station (LAN, CPython) there is no
+        server to ask: with blocking, before the loop, getaddrinfo() looks
+        the names up"""
+        for client in (self.time_sync, self.syslog):
+            if client is None or client.address is not None or \
+               getattr(client, 'synced', None) is not None:
+                continue
+            host = client.host
+            try:
+                if not numeric(host):
+                    lookup = self.lookups.get(host)
+                    if lookup is None:
+                        server = self.network.dns()
+                        if server is None:
+                            if blocking:
+                                client.resolve()
+                            continue
+                        lookup = self.lookups[host] = Lookup(host, server)
+                    host = lookup.tick()
+                    if host is None:
+                        continue
+                client.resolve(host)
+            except OSError as e:
+                print('Lookup of {0} failed, {1}'.format(client.host, e))
+
+    def stats_address(self):
+        # "stats": {"bind": <address>} serves a JSON dump of the stats to
+        # whoever connects to it
+        if 'stats' in self.config:
+            return parse_bind_address(self.config['stats']['bind'])
+
+    def bind_stats(self, poller):
+        address = self.stats_address()
+        if address is None:
+            return
+        sock = socket.socket()
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(address)
+        sock.listen(2)
+        poller.register(sock, self.handle_stats)
+        self.stats_server = sock
+        print('Stats at TCP({0})'.format(address[1]))
+
+    def handle_stats(self, _, event):
+        sock, address = self.stats_server.accept()
+        try:
+            sock.sendall(json.dumps(self.get_stats()).encode() + b'\n')
+        except OSError as e:
+            print('Stats client ', address, ' error ', e)
+        finally:
+            sock.close()
+
+    def create_control(self):
+        # "control": {"bind": <address>} is a command port, see us2n_control
+        if 'control' in self.config:
+            import us2n_control
+            self.control = us2n_control.Control(self, self.config['control'])
+            return self.control
+
+    def close_stats(self):
+        if self.stats_server is not None:
+            self.poller.unregister(self.stats_server)
+            self.stats_server.close()
+            self.stats_server = None
 
     def report_exception(self, e):
-        if 'syslog' in self.config:
+        if self.syslog is not None:
             try:
-                import usyslog
                 import io
-                import sys
                 stringio = io.StringIO()
                 sys.print_exception(e, stringio)
-                stringio.seek(0)
-                e_string = stringio.read()
-                s = usyslog.UDPClient(**self.config['syslog'])
-                s.error(e_string)
-                s.close()
+                self.syslog.error(stringio.getvalue())
+                self.syslog.drain()
             except BaseException as e2:
                 sys.print_exception(e2)
 
     def serve_forever(self):
         while True:
-            config_network(self.config.get('wlan'), self.config.get('name'))
             try:
                 self._serve_forever()
             except KeyboardInterrupt:
                 print('Ctrl-C pressed. Bailing out')
                 break
+            except ConfigChanged:
+                print('Configuration changed. Restarting')
             except BaseException as e:
                 import sys
                 sys.print_exception(e)
@@ -460,106 +1732,374 @@ class S2NServer:
                 time.sleep(1)
                 print("Restarting")
 
-    def bind(self):
-        bridges = []
-        for config in self.config['bridges']:
-            bridge = Bridge(config)
-            bridge.bind()
-            bridges.append(bridge)
-        return bridges
+    def create_pool(self, extra=0):
+        # the buffers of all the bridges, in one block. After a restart,
+        # the previous one is let go first: both would not fit
+        self.pool = self.poller = None
+        self.bridges = []
+        self.pool = Pool(extra + sum(buffer_size(config)
+                                     for config in self.config['bridges']))
+        return self.pool
+
+    def create_bridges(self):
+        # bridges listen once bring_up() says so
+        pool = self.create_pool(RX_SIZE)
+        rx = pool.take(RX_SIZE)
+        return [Bridge(config, pool, rx) for config in self.config['bridges']]
+
+    def save_config(self):
+        """Write the configuration (bridges included, as changed at run
+        time) to a temporary file renamed over the configuration file"""
+        temp = self.filename + '.tmp'
+        with open(temp, 'w') as f:
+            json.dump(self.config, f)
+        os.rename(temp, self.filename)
+        print('Configuration saved to {0}'.format(self.filename))
+        # already in use: not a change to reload
+        if self.config_key is not None:
+            self.config_key = file_key(self.filename, crc=True)
+
+    def check_config(self):
+        """Raise ConfigChanged once the configuration file was changed
+        into a valid configuration, which replaces the current one.
+        Bridges are created again, WLAN changes need a reset"""
+        if self.config_key is None:
+            return
+        key = file_key(self.filename)
+        if key is not None and not key[1] and key[0] == self.config_key[0]:
+            # no mtime and the same size: the contents are compared (a read
+            # of the whole file) every CONFIG_CRC_MS only
+            now = ticks_ms()
+            if ticks_diff(now, self.crc_checked) < CONFIG_CRC_MS:
+                return
+            self.crc_checked = now
+            key = file_key(self.filename, crc=True)
+        if key is None or key == self.config_key:
+            return
+        self.config_key = key
+        try:
+            config, self.config_key = load_config(self.filename)
+        except (OSError, ValueError, TypeError, KeyError,
+                AttributeError) as e:
+            print('Configuration not reloaded: {0!r}'.format(e))
+            return
+        self.config.clear()
+        self.config.update(config)
+        config_verbosity(self.config)
+        if self.time_sync is None and \
+           any('ssl' in bridge for bridge in config['bridges']):
+            self.time_sync = TimeSync(**config.get('ntp', {}))
+        raise ConfigChanged()
 
     def _serve_forever(self):
-        bridges = self.bind()
+        self.bridges = bridges = self.create_bridges()
+        self.pending = list(bridges)
+        self.poller = poller = Poller()
+        for bridge in bridges:
+            bridge.save_config = self.save_config
+            bridge.inband = 'control' not in self.config
+            bridge.register(poller)
+        self.bind_stats(poller)
+        if self.create_control() is not None:
+            self.control.bind(poller)
+        self.network.start()
+        if self.network.ready():
+            self.resolve_hosts(blocking=True)
+        # period (ms) of the housekeeping tick, shorter during bring-up
+        tick = self.config.get('tick', 1000)
+        last_tick = ticks_ms()
+
+        # bridges which may hold UART data for a while
+        packetized = [bridge for bridge in bridges if bridge.packetize]
 
         try:
             while True:
-                fds = []
-                for bridge in bridges:
-                    bridge.fill(fds)
-                rlist, _, xlist = select.select(fds, (), fds)
-                if xlist:
-                    print('Errors. bailing out')
-                    break
-                for fd in rlist:
+                period = min(tick, 100) if self.pending else tick
+                timeout = period
+                for bridge in packetized:
+                    wait = bridge.packet_wait(ticks_ms())
+                    if wait is not None and wait < timeout:
+                        timeout = wait
+                poller.dispatch(timeout)
+                now = ticks_ms()
+                for bridge in packetized:
+                    bridge.flush_held(now)
+                if ticks_diff(now, last_tick) >= period:
+                    last_tick = now
+                    for bridge in self.bring_up():
+                        bridge.bind()
                     for bridge in bridges:
-                        bridge.handle(fd)
+                        bridge.tick()
+                    self.boot_times()
+                    if self.syslog is not None:
+                        self.syslog.drain()
+                    self.check_config()
         finally:
+            self.close_stats()
+            if self.control is not None:
+                self.control.close()
+                self.control = None
             for bridge in bridges:
                 bridge.close()
 
 
-def config_lan(config, name):
-    # For a board which has LAN
-    pass
-
-
-def config_wlan(config, name):
-    if config is None:
-        return None, None
-    return (WLANStation(config.get('sta'), name),
-            WLANAccessPoint(config.get('ap'), name))
-
-
-def WLANStation(config, name):
-    if config is None:
-        return
-    config.setdefault('connection_attempts', -1)
-    essid = config['essid']
-    password = config['password']
-    attempts_left = config['connection_attempts']
-    sta = network.WLAN(network.STA_IF)
-
-    if not sta.isconnected():
-        while not sta.isconnected() and attempts_left != 0:
-            attempts_left -= 1
-            sta.disconnect()
-            sta.active(False)
-            sta.active(True)
-            sta.connect(essid, password)
-            print('Connecting to WiFi...')
-            n, ms = 20, 250
-            t = n*ms
-            while not sta.isconnected() and n > 0:
-                time.sleep_ms(ms)
-                n -= 1
-        if not sta.isconnected():
-            print('Failed to connect wifi station after {0}ms. I give up'
-                  .format(t))
-            return sta
-    print('Wifi station connected as {0}'.format(sta.ifconfig()))
-    return sta
-
-
-def WLANAccessPoint(config, name):
-    if config is None:
-        return
-    config.setdefault('essid', name)
-    config.setdefault('channel', 11)
-    config.setdefault('authmode', getattr(network,'AUTH_OPEN'))
-    config.setdefault('hidden', False)
-    ap = network.WLAN(network.AP_IF)
-    
-    if not ap.isconnected():
-        ap.config(**config)
-        ap.active(True)
-        n, ms = 20, 250
-        t = n * ms
-        while not ap.active() and n > 0:
-            time.sleep_ms(ms)
-            n -= 1
-        if not ap.active():
-            print('Failed to activate wifi access point after {0}ms. ' \
-                  'I give up'.format(t))
-            return ap
-
-    print('Wifi {0!r} connected as {1}'.format(ap.config('essid'),
-                                               ap.ifconfig()))
-    return ap
-
-
-def config_network(config, name):
-    config_lan(config, name)
-    config_wlan(config, name)
+class Network:
+    """WLAN bring-up and reconnection as a state machine advanced by
+    tick(), so that the bridges are served meanwhile"""
+
+    def __init__(self, config, name):
+        self.config = config or {}
+        self.name = name
+        self.sta = self.ap = None
+        self.sta_up = self.ap_up = False
+        self.attempts_left = -1
+        self.connecting = None
+        # ticks_ms() when an interface first came up
+        self.up = None
+
+    def start(self):
+        if self.sta is not None or self.ap is not None:
+            return
+        sta_config, ap_config = self.config.get('sta'), self.config.get('ap')
+        if sta_config is not None:
+            self.sta = network.WLAN(network.STA_IF)
+            self.attempts_left = sta_config.get('connection_attempts', -1)
+            if not self.sta.isconnected():
+                self.connect()
+        if ap_config is not None:
+            ap_config = dict(ap_config)
+            ap_config.setdefault('essid', self.name)
+            ap_config.setdefault('channel', 11)
+            ap_config.setdefault('authmode', getattr(network, 'AUTH_OPEN'))
+            ap_config.setdefault('hidden', False)
+            self.ap = network.WLAN(network.AP_IF)
+            if not self.ap.isconnected():
+                self.ap.config(**ap_config)
+                self.ap.active(True)
+        self.tick()
+
+    def connect(self):
+        if self.attempts_left == 0:
+            return
+        self.attempts_left -= 1
+        sta, config = self.sta, self.config['sta']
+        sta.disconnect()
+        sta.active(False)
+        sta.active(True)
+        sta.connect(config['essid'], config['password'])
+        self.connecting = ticks_ms()
+        print('Connecting to WiFi...')
+
+    def tick(self):
+        sta, ap = self.sta, self.ap
+        if sta is not None:
+            if sta.isconnected():
+                if not self.sta_up:
+                    self.sta_up = True
+                    self.connecting = None
+                    self.attempts_left = \
+                        self.config['sta'].get('connection_attempts', -1)
+                    print('Wifi station connected as {0}'
+                          .format(sta.ifconfig()))
+            elif self.sta_up:
+                self.sta_up = False
+                print('Wifi station disconnected')
+                self.connect()
+            elif self.connecting is not None and \
+                    ticks_diff(ticks_ms(), self.connecting) >= 5000:
+                if self.attempts_left == 0:
+                    self.connecting = None
+                    print('Failed to connect wifi station. I give up')
+                else:
+                    self.connect()
+        if ap is not None and not self.ap_up and ap.active():
+            self.ap_up = True
+            print('Wifi {0!r} connected as {1}'.format(ap.config('essid'),
+                                                       ap.ifconfig()))
+        if self.up is None and self.ready():
+            self.up = ticks_ms()
+
+    def ready(self, host=''):
+        """True when an interface serving host ('' for any) is up"""
+        if self.sta is None and self.ap is None:
+            # LAN or no WLAN configuration: nothing to wait for
+            return True
+        interfaces = [iface for iface, up in ((self.sta, self.sta_up),
+                                              (self.ap, self.ap_up)) if up]
+        if not host:
+            return bool(interfaces)
+        return any(iface.ifconfig()[0] == host for iface in interfaces)
+
+    def dns(self):
+        """DNS server of the station while it is connected, else None (the
+        access point has no upstream DNS)"""
+        if self.sta is not None and self.sta_up:
+            server = self.sta.ifconfig()[3]
+            if server and server != '0.0.0.0':
+                return server
+        return None
+
+
+class Lookup:
+    """Looks a host name up without blocking, unlike getaddrinfo(): an A
+    query is sent to a DNS server from tick() and the answer picked up by
+    the following ticks. It is sent again, less and less often, until a
+    reply has an address"""
+
+    def __init__(self, host, server):
+        self.host = host
+        self.server = server
+        self.address = None
+        self.sock = None
+        self.sent = None
+        self.wait = 2000
+        self.id = 0
+
+    def tick(self):
+        """The IP address once known, else None"""
+        if self.address is not None:
+            return self.address
+        now = ticks_ms()
+        if self.sock is not None:
+            try:
+                self.address = self.answer(self.sock.recv(512))
+                if self.address is not None:
+                    self.close()
+                    return self.address
+            except (OSError, IndexError) as e:
+                if not isinstance(e, OSError) or \
+                   e.args[0] not in WOULDBLOCK:
+                    print('Lookup of {0} failed, {1}'.format(self.host, e))
+                    self.close()
+        if self.sent is None or ticks_diff(now, self.sent) >= self.wait:
+            if self.sent is not None:
+                self.wait = min(2 * self.wait, MAX_LOOKUP_WAIT)
+            self.query(now)
+        return None
+
+    def query(self, now):
+        self.close()
+        self.sent = now
+        self.id = now & 0xffff
+        # header: id, recursion desired, one question
+        msg = bytearray(self.id.to_bytes(2, 'big') + b'\x01\x00\x00\x01' +
+                        bytes(6))
+        for label in self.host.split('.'):
+            msg.append(len(label))
+            msg.extend(label.encode())
+        # end of the name, type A, class IN
+        msg.extend(b'\x00\x00\x01\x00\x01')
+        try:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.setblocking(False)
+            self.sock = sock
+            sock.sendto(msg, socket.getaddrinfo(self.server, 53)[0][-1])
+        except OSError as e:
+            print('Lookup of {0} failed, {1}'.format(self.host, e))
+            self.close()
+
+    def answer(self, msg):
+        # the first A record of the reply to the last query, None for
+        # another message. OSError if the reply has none
+        if len(msg) < 12 or int.from_bytes(msg[:2], 'big') != self.id:
+            return None
+        if msg[3] & 0x0f:
+            raise OSError('DNS error {0}'.format(msg[3] & 0x0f))
+        i = skip_name(msg, 12) + 4
+        for _ in range(int.from_bytes(msg[6:8], 'big')):
+            i = skip_name(msg, i)
+            rtype = int.from_bytes(msg[i:i + 2], 'big')
+            size = int.from_bytes(msg[i + 8:i + 10], 'big')
+            i += 10
+            if rtype == 1 and size == 4:
+                return '.'.join(str(byte) for byte in msg[i:i + 4])
+            i += size
+        raise OSError('no address')
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+
+def skip_name(msg, i):
+    # index past the DNS name at i, which may end with a pointer
+    while msg[i]:
+        if msg[i] >= 0xc0:
+            return i + 2
+        i += msg[i] + 1
+    return i + 1
+
+
+class TimeSync:
+    """Sets the RTC from an NTP server without blocking: the request is
+    sent from tick() and the answer picked up by the following ticks. The
+    host is looked up beforehand, see S2NServer.resolve_hosts"""
+
+    def __init__(self, host='pool.ntp.org', retry=15000):
+        self.host = host
+        self.retry = retry
+        self.address = None
+        self.sock = None
+        self.sent = None
+        self.synced = None
+        if not hasattr(machine, 'RTC'):
+            # the host keeps its own time
+            self.synced = ticks_ms()
+
+    def tick(self):
+        if self.synced is not None:
+            return True
+        if self.address is None:
+            return False
+        now = ticks_ms()
+        if self.sock is not None:
+            try:
+                self.set_time(self.sock.recv(48))
+                self.synced = now
+                print('NTP synchronization succeeded, {0}'
+                      .format(time.gmtime()))
+                self.close()
+                return True
+            except OSError as e:
+                if e.args[0] not in WOULDBLOCK:
+                    print('NTP synchronization failed, {0}'.format(e))
+                    self.close()
+        if self.sent is None or ticks_diff(now, self.sent) >= self.retry:
+            self.request(now)
+        return False
+
+    def resolve(self, host=None):
+        # blocking unless host is a numeric address
+        self.address = socket.getaddrinfo(host or self.host, 123)[0][-1]
+
+    def request(self, now):
+        self.close()
+        self.sent = now
+        try:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.setblocking(False)
+            self.sock = sock
+            query = bytearray(48)
+            query[0] = 0x1B
+            sock.sendto(query, self.address)
+        except OSError as e:
+            print('NTP synchronization failed, {0}'.format(e))
+            self.close()
+
+    def set_time(self, msg):
+        import struct
+        seconds = struct.unpack('!I', msg[40:44])[0]
+        # NTP counts from 1900, the port from 1970 or 2000
+        delta = 3155673600 if time.gmtime(0)[0] == 2000 else 2208988800
+        tm = time.gmtime(seconds - delta)
+        machine.RTC().datetime((tm[0], tm[1], tm[2], tm[6] + 1,
+                                tm[3], tm[4], tm[5], 0))
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
 
 
 def config_verbosity(config):
@@ -571,10 +2111,14 @@ def config_verbosity(config):
 
 
 def server(config_filename='us2n.json'):
-    config = read_config(config_filename)
+    config, key = load_config(config_filename)
     VERBOSE = config.setdefault('verbose', 1)
     name = config.setdefault('name', 'Tiago-ESP32')
     config_verbosity(config)
     print(50*'=')
     print('Welcome to ESP8266/32 serial <-> tcp bridge\n')
-    return S2NServer(config)
+    # engine: 'poll' (default) or 'asyncio'
+    if config.get('engine') == 'asyncio':
+        import us2n_async
+        return us2n_async.AsyncS2NServer(config, config_filename, key)
+    return S2NServer(config, config_filename, key)
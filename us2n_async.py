@@ -0,0 +1,290 @@
+# us2n_async.py
+#
+# (u)asyncio engine for us2n: select it with "engine": "asyncio" in
+# us2n.json. Runs on MicroPython and on CPython (with machine/network
+# modules providing the UARTs), which makes it possible to load test
+# bridges on a PC.
+
+import sys
+import json
+
+try:
+    import asyncio
+except ImportError:
+    import uasyncio as asyncio
+
+from us2n import Bridge, Client, S2NServer, POLLIN, print, ticks_ms, \
+    parse_bind_address, HISTORY_USAGE
+
+MICROPYTHON = sys.implementation.name == 'micropython'
+
+
+def copy(data):
+    # CPython transports may keep the buffers given to write() until they
+    # are sent: ring buffer views must be copied. MicroPython copies them
+    return data if MICROPYTHON else bytes(data)
+
+
+async def readable(obj):
+    # CPython only: wait until obj.fileno() is readable
+    loop = asyncio.get_running_loop()
+    fd = obj.fileno()
+    future = loop.create_future()
+    loop.add_reader(fd, lambda: future.done() or future.set_result(None))
+    try:
+        await future
+    finally:
+        loop.remove_reader(fd)
+
+
+class AsyncClient(Client):
+    """Client on an asyncio stream: send() only queues data, the writer
+    task of the bridge empties the queue"""
+
+    def __init__(self, writer, address, queue_size=4096, overflow='drop',
+                 queue=None):
+        super().__init__(writer, address, queue_size, overflow, queue)
+        self.ready = asyncio.Event()
+
+    def write(self, data):
+        return 0
+
+    def close(self):
+        super().close()
+        # wake up the writer task so it finishes
+        self.ready.set()
+
+
+class AsyncBridge(Bridge):
+
+    def __init__(self, config, pool=None):
+        super().__init__(config, pool)
+        self.server = None
+        self.error = None
+        # set when UART data starts being held back
+        self.holding = asyncio.Event()
+
+    def bind(self):
+        # the listener is created by start(), in the event loop
+        if 'ssl' in self.config:
+            self.load_ssl()
+
+    async def start(self):
+        host, port = self.address
+        kwargs = {}
+        if self.ssl is not None:
+            # needs a port with ssl.SSLContext
+            kwargs['ssl'] = self.ssl
+        self.server = await asyncio.start_server(
+            self.serve_client, host or '0.0.0.0', port, **kwargs)
+        print('Bridge listening at TCP({0}) for UART({1})'
+              .format(self.bind_port, self.uart_port))
+        if 'history' in self.config:
+            host, port = parse_bind_address(self.config['history']['bind'])
+            self.history = await asyncio.start_server(
+                self.serve_history, host or '0.0.0.0', port)
+
+    async def serve_history(self, reader, writer):
+        if not self.history_queues:
+            print('History client refused: too many')
+            writer.close()
+            return
+        # only counts the history clients here: writes go to the streams
+        queue = self.history_queues.pop()
+        try:
+            cursor = self.history_cursor(await reader.readline())
+            if cursor is None:
+                writer.write(HISTORY_USAGE.encode())
+            while cursor is not None and len(cursor):
+                data = cursor.peek()
+                writer.write(copy(data))
+                cursor.commit(len(data))
+                self.stats['history_tx'] += len(data)
+                await writer.drain()
+            await writer.drain()
+        except OSError as e:
+            print('History client error ', e)
+        finally:
+            self.history_queues.append(queue)
+            writer.close()
+
+    def update_events(self, client):
+        if client.has_output():
+            client.ready.set()
+
+    async def serve_client(self, reader, writer):
+        address = writer.get_extra_info('peername')
+        print('Accepted connection from ', address)
+        self.make_room()
+        if self.nodelay:
+            # CPython transports already set TCP_NODELAY
+            if MICROPYTHON:
+                self.set_nodelay(writer.s)
+        client = AsyncClient(writer, address, self.queue_size, self.overflow,
+                             self.queues.pop())
+        asyncio.create_task(self.write_client(client))
+        self.add_client(client)
+        try:
+            while client.sock is not None:
+                data = await reader.read(4096)
+                if not data:
+                    print('Client ', client.address, ' disconnected')
+                    break
+                self.handle_data(client, data)
+        except OSError as e:
+            print('Client ', client.address, ' receive error ', e)
+        finally:
+            self.close_client(client)
+
+    async def write_client(self, client):
+        queue, writer = client.queue, client.sock
+        try:
+            while client.sock is not None:
+                await client.ready.wait()
+                client.ready.clear()
+                while queue.has_data() and client.sock is not None:
+                    data = queue.peek()
+                    writer.write(copy(data))
+                    queue.commit(len(data))
+                    await writer.drain()
+                if client.cursor is not None and client.sock is not None:
+                    # the next part of the history replay
+                    self.catch_up(client)
+        except OSError as e:
+            print('Client ', client.address, ' send error ', e)
+            self.close_client(client)
+
+    async def run_uart(self):
+        try:
+            if MICROPYTHON:
+                stream = asyncio.StreamReader(self.uart)
+                ring = self.ring_buffer
+                while True:
+                    n = await stream.readinto(ring.reserve(self.chunk))
+                    if n:
+                        ring.produce(n)
+                        self.check_delimiter(n)
+                        self.uart_received(n)
+                    # drain the rest and send to the clients
+                    self.handle_uart(None, POLLIN)
+            else:
+                while True:
+                    await readable(self.uart)
+                    self.handle_uart(None, POLLIN)
+        except Exception as e:
+            # re-raised by the server main task
+            self.error = e
+
+    def hold_uart(self):
+        super().hold_uart()
+        if self.held is not None:
+            self.holding.set()
+
+    async def run_packets(self):
+        # send held UART data when it is due
+        while True:
+            await self.holding.wait()
+            self.holding.clear()
+            while True:
+                wait = self.packet_wait(ticks_ms())
+                if wait is None:
+                    break
+                await asyncio.sleep(wait / 1000)
+                self.flush_held(ticks_ms())
+
+    def close(self):
+        if self.history is not None:
+            # an asyncio server, not a socket
+            self.history.close()
+            self.history = None
+        super().close()
+        if self.server is not None:
+            self.server.close()
+            self.server = None
+
+
+class AsyncS2NServer(S2NServer):
+
+    def create_bridges(self):
+        pool = self.create_pool()
+        return [AsyncBridge(config, pool) for config in self.config['bridges']]
+
+    def _serve_forever(self):
+        if MICROPYTHON:
+            # clear the state left by a previous failed run
+            asyncio.new_event_loop()
+        asyncio.run(self.serve())
+
+    async def serve_stats(self, reader, writer):
+        try:
+            writer.write(json.dumps(self.get_stats()).encode() + b'\n')
+            await writer.drain()
+        except OSError as e:
+            print('Stats client error ', e)
+        finally:
+            writer.close()
+
+    async def serve_control(self, reader, writer):
+        from us2n_control import Session
+        session = Session(writer, writer.get_extra_info('peername'))
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                reply = self.control.command(session, line)
+                if reply is None:
+                    break
+                writer.write(reply)
+                await writer.drain()
+        except OSError as e:
+            print('Control client error ', e)
+        finally:
+            writer.close()
+
+    async def serve(self):
+        self.bridges = bridges = self.create_bridges()
+        self.pending = list(bridges)
+        stats_server = control_server = None
+        try:
+            for bridge in bridges:
+                bridge.save_config = self.save_config
+                bridge.inband = 'control' not in self.config
+                asyncio.create_task(bridge.run_uart())
+                if bridge.packetize:
+                    asyncio.create_task(bridge.run_packets())
+            address = self.stats_address()
+            if address is not None:
+                stats_server = await asyncio.start_server(
+                    self.serve_stats, address[0] or '0.0.0.0', address[1])
+            control = self.create_control()
+            if control is not None:
+                control_server = await asyncio.start_server(
+                    self.serve_control, control.address[0] or '0.0.0.0',
+                    control.address[1])
+            self.network.start()
+            if self.network.ready():
+                self.resolve_hosts(blocking=True)
+            # period (ms) of the housekeeping tick, shorter during bring-up
+            tick = self.config.get('tick', 1000)
+            while True:
+                await asyncio.sleep((min(tick, 100) if self.pending
+                                     else tick) / 1000)
+                for bridge in self.bring_up():
+                    bridge.bind()
+                    await bridge.start()
+                for bridge in bridges:
+                    if bridge.error is not None:
+                        raise bridge.error
+                    bridge.tick()
+                self.boot_times()
+                if self.syslog is not None:
+                    self.syslog.drain()
+                self.check_config()
+        finally:
+            if stats_server is not None:
+                stats_server.close()
+            if control_server is not None:
+                control_server.close()
+            for bridge in bridges:
+                bridge.close()
@@ -0,0 +1,204 @@
+# us2n_control.py
+#
+# Control port of a us2n server: enable it with "control": {"bind": ...}
+# in us2n.json. Bridges are controlled there rather than in their data
+# stream, which then goes to the UART untouched. Commands are text lines,
+# each answered with a line of JSON:
+#
+#   bridges                           ports, UART settings and lines
+#   stats                             the statistics dump
+#   uart <port> <setting>=<value>...  change (and save) UART settings
+#   break <port>                      send a BREAK
+#   dtr <port> on|off                 set a modem control line
+#   rts <port> on|off
+#   auth <password>                   first, if "password" is set
+#   quit
+#
+# <port> is the TCP port of the bridge.
+
+import json
+import socket
+
+from us2n import POLLERR, parse_bind_address, same_secret, validate_config, \
+    print
+
+# longest command line
+MAX_LINE = 256
+
+# settings the uart command may change
+SETTINGS = ('baudrate', 'bits', 'parity', 'stop', 'flow')
+
+
+class Session:
+
+    def __init__(self, sock, address):
+        self.sock = sock
+        self.address = address
+        # start of a line not complete yet
+        self.line = b''
+        self.authenticated = False
+
+    def feed(self, data):
+        """Complete lines of data"""
+        lines = (self.line + data).split(b'\n')
+        self.line = lines.pop()
+        if len(self.line) > MAX_LINE:
+            self.line = b''
+            lines.append(None)
+        return lines
+
+
+class Control:
+
+    def __init__(self, server, config):
+        self.server = server
+        self.address = parse_bind_address(config['bind'])
+        password = config.get('password')
+        self.password = password.encode() if password else None
+        self.sock = None
+        self.poller = None
+        self.sessions = []
+
+    def command(self, session, line):
+        """Reply to a command line, None to close the session"""
+        if line is None:
+            return self.reply(error='line too long')
+        try:
+            words = line.decode().split()
+        except ValueError:
+            return self.reply(error='not text')
+        if not words:
+            return b''
+        name, args = words[0].lower(), words[1:]
+        if name == 'quit':
+            return None
+        if name == 'auth':
+            session.authenticated = self.password is None or \
+                same_secret(' '.join(args).encode(), self.password)
+            if not session.authenticated:
+                print('Control client ', session.address,
+                      ' authentication failed')
+                return self.reply(error='authentication failed')
+            return self.reply(ok=True)
+        if self.password is not None and not session.authenticated:
+            return self.reply(error='auth <password> first')
+        handler = getattr(self, 'do_' + name, None)
+        if handler is None:
+            return self.reply(error='unknown command ' + name)
+        try:
+            return self.reply(handler(*args))
+        except (TypeError, ValueError, KeyError, AttributeError,
+                OSError) as e:
+            return self.reply(error='{0}: {1}'.format(name, e))
+
+    def reply(self, value=None, **kwargs):
+        return json.dumps(kwargs or value).encode() + b'\n'
+
+    def bridge(self, port):
+        port = int(port)
+        for bridge in self.server.bridges:
+            if bridge.bind_port == port:
+                return bridge
+        raise ValueError('no bridge at port {0}'.format(port))
+
+    def do_bridges(self):
+        return [dict(port=bridge.bind_port, uart=bridge.config['uart'],
+                     clients=len(bridge.clients),
+                     lines={name: bridge.line_on(name)
+                            for name in bridge.lines})
+                for bridge in self.server.bridges]
+
+    def do_stats(self):
+        return self.server.get_stats()
+
+    def do_uart(self, port, *settings):
+        bridge = self.bridge(port)
+        changes = {}
+        for setting in settings:
+            key, value = setting.split('=')
+            if key not in SETTINGS:
+                raise ValueError('unknown setting ' + key)
+            changes[key] = None if value.lower() == 'none' else int(value)
+        if not changes:
+            raise ValueError('no settings')
+        if changes.get('flow') and getattr(bridge.uart, 'RTS', None) is None:
+            raise ValueError('no flow control on this port')
+        # what is saved must load at the next boot
+        uart = dict(bridge.config['uart'])
+        uart.update(changes)
+        config = dict(self.server.config)
+        config['bridges'] = [dict(item, uart=uart) if item is bridge.config
+                             else item for item in config['bridges']]
+        validate_config(config)
+        if not bridge.configure_uart(**changes):
+            raise ValueError('settings refused')
+        if bridge.save_config is not None:
+            bridge.save_config()
+        return bridge.config['uart']
+
+    def do_break(self, port):
+        self.bridge(port).uart.sendbreak()
+        return dict(ok=True)
+
+    def set_line(self, name, port, state):
+        if state not in ('on', 'off'):
+            raise ValueError('on or off')
+        if not self.bridge(port).set_line(name, state == 'on'):
+            raise ValueError('no pin for ' + name)
+        return dict(ok=True)
+
+    def do_dtr(self, port, state):
+        return self.set_line('dtr', port, state)
+
+    def do_rts(self, port, state):
+        return self.set_line('rts', port, state)
+
+    # poll engine
+
+    def bind(self, poller):
+        sock = socket.socket()
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(self.address)
+        sock.listen(2)
+        self.sock = sock
+        self.poller = poller
+        poller.register(sock, self.handle_accept)
+        print('Control at TCP({0})'.format(self.address[1]))
+
+    def handle_accept(self, _, event):
+        sock, address = self.sock.accept()
+        # replies are short: sent blocking, for a second at most
+        sock.settimeout(1)
+        session = Session(sock, address)
+        self.sessions.append(session)
+        self.poller.register(sock, self.handle_session, session)
+
+    def handle_session(self, session, event):
+        try:
+            data = b'' if event & POLLERR else session.sock.recv(MAX_LINE)
+            if not data:
+                self.close_session(session)
+                return
+            for line in session.feed(data):
+                reply = self.command(session, line)
+                if reply is None:
+                    self.close_session(session)
+                    return
+                session.sock.sendall(reply)
+        except OSError as e:
+            print('Control client ', session.address, ' error ', e)
+            self.close_session(session)
+
+    def close_session(self, session):
+        if session in self.sessions:
+            self.sessions.remove(session)
+            self.poller.unregister(session.sock)
+            session.sock.close()
+
+    def close(self):
+        for session in list(self.sessions):
+            self.close_session(session)
+        if self.sock is not None:
+            self.poller.unregister(self.sock)
+            self.sock.close()
+            self.sock = None
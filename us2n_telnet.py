@@ -0,0 +1,220 @@
+# us2n_telnet.py
+#
+# Telnet (RFC 854) and serial port control (RFC 2217) for us2n bridges:
+# enable it per bridge with "telnet": {} in us2n.json. Client data is
+# parsed as it arrives, in whole runs between IAC bytes, so commands may
+# be split across reads or embedded in data.
+
+import machine
+
+IAC, DONT, DO, WONT, WILL, SB, SE = 255, 254, 253, 252, 251, 250, 240
+BRK, IP, AYT = 243, 244, 246
+BINARY, SGA, COM_PORT_OPTION = 0, 3, 44
+
+# COM-PORT-OPTION commands. The server answers with command + 100
+SIGNATURE = 0
+SET_BAUDRATE, SET_DATASIZE, SET_PARITY, SET_STOPSIZE, SET_CONTROL = 1, 2, 3, 4, 5
+NOTIFY_LINESTATE, NOTIFY_MODEMSTATE = 6, 7
+FLOWCONTROL_SUSPEND, FLOWCONTROL_RESUME = 8, 9
+SET_LINESTATE_MASK, SET_MODEMSTATE_MASK, PURGE_DATA = 10, 11, 12
+
+# RFC 2217 values <-> machine.UART parity and stop bits
+PARITIES = {1: None, 2: 1, 3: 0}
+STOPSIZES = {1: 1, 2: 2}
+# data sizes which may be set. Others are answered with the one in use
+DATASIZES = (5, 6, 7, 8)
+
+# SET-CONTROL values
+FLOW_REQUEST, FLOW_NONE, FLOW_XONXOFF, FLOW_HARDWARE = 0, 1, 2, 3
+BREAK_REQUEST, BREAK_ON, BREAK_OFF = 4, 5, 6
+DTR_REQUEST, DTR_ON, RTS_REQUEST, RTS_ON = 7, 8, 10, 11
+INFLOW_REQUEST, INFLOW_NONE, INFLOW_HARDWARE = 13, 14, 16
+
+HARDWARE_FLOW = getattr(machine.UART, 'RTS', 0) | \
+    getattr(machine.UART, 'CTS', 0)
+
+# no modem lines: report CD, DSR and CTS on
+MODEM_STATE = b'\xb0'
+
+DATA, COMMAND, OPTION, SUB, SUB_IAC = range(5)
+MAX_SUB = 64
+
+
+def escape(data):
+    """Double the IAC bytes of data sent to a telnet client"""
+    data = bytes(data)
+    if b'\xff' in data:
+        data = data.replace(b'\xff', b'\xff\xff')
+    return data
+
+
+def code(table, value):
+    for key, item in table.items():
+        if item == value:
+            return key
+    return 1
+
+
+class Telnet:
+    """Telnet state of one client of a bridge"""
+
+    def __init__(self, bridge, client, rfc2217=True):
+        self.bridge = bridge
+        self.client = client
+        self.options = (BINARY, SGA, COM_PORT_OPTION) if rfc2217 \
+            else (BINARY, SGA)
+        # options enabled on our side (DO/WILL) and on the client side
+        self.local = set()
+        self.remote = set()
+        self.state = DATA
+        self.verb = None
+        self.sub = bytearray()
+
+    def feed(self, data):
+        """Parse client data: plain data goes on to the bridge input
+        stages, commands and negotiations are answered"""
+        bridge, client = self.bridge, self.client
+        view = memoryview(data)
+        i, n = 0, len(data)
+        while i < n:
+            state = self.state
+            if state == DATA or state == SUB:
+                j = data.find(b'\xff', i)
+                end = n if j < 0 else j
+                if end > i:
+                    if state == DATA:
+                        bridge.handle_input(client, data, i, end)
+                    elif len(self.sub) < MAX_SUB:
+                        self.sub.extend(view[i:end])
+                if j < 0:
+                    return
+                i = j + 1
+                self.state = COMMAND if state == DATA else SUB_IAC
+                continue
+            c = data[i]
+            i += 1
+            if state == COMMAND:
+                self.state = DATA
+                if c == IAC:
+                    bridge.handle_input(client, b'\xff', 0, 1)
+                elif c >= WILL:
+                    self.verb = c
+                    self.state = OPTION
+                elif c == SB:
+                    self.sub = bytearray()
+                    self.state = SUB
+                else:
+                    bridge.telnet_command(client, c)
+            elif state == OPTION:
+                self.state = DATA
+                self.negotiate(self.verb, c)
+            elif c == IAC:
+                self.sub.append(IAC)
+                self.state = SUB
+            else:
+                self.state = DATA
+                if c == SE:
+                    self.subnegotiation(self.sub)
+
+    def send(self, *data):
+        self.bridge.send(self.client, bytes(data))
+
+    def negotiate(self, verb, option):
+        if verb == DO or verb == DONT:
+            enabled, yes, no = self.local, WILL, WONT
+        else:
+            enabled, yes, no = self.remote, DO, DONT
+        if verb == DO or verb == WILL:
+            if option not in self.options:
+                self.send(IAC, no, option)
+            elif option not in enabled:
+                enabled.add(option)
+                self.send(IAC, yes, option)
+                if option == COM_PORT_OPTION and enabled is self.remote:
+                    self.notify(NOTIFY_MODEMSTATE, MODEM_STATE)
+        elif option in enabled:
+            enabled.remove(option)
+            self.send(IAC, no, option)
+
+    def subnegotiation(self, sub):
+        if len(sub) < 2 or sub[0] != COM_PORT_OPTION or \
+           COM_PORT_OPTION not in self.options:
+            return
+        command = sub[1]
+        value = self.com_port(command, bytes(sub[2:]))
+        if value is not None:
+            self.notify(command, value)
+
+    def notify(self, command, value):
+        self.bridge.send(self.client, bytes(
+            (IAC, SB, COM_PORT_OPTION, command + 100)) +
+            escape(value) + bytes((IAC, SE)))
+
+    def com_port(self, command, value):
+        """Handle a COM-PORT-OPTION command. Returns the value to answer
+        with (the settings in use) or None for no answer"""
+        bridge, client = self.bridge, self.client
+        uart = bridge.config['uart']
+        # read-only (or not authenticated) clients may ask but not change
+        writer = client.state == 'authenticated' and bridge.can_write(client)
+        number = int.from_bytes(value, 'big') if value else 0
+        if command == SIGNATURE:
+            return None if value else b'us2n'
+        elif command == SET_BAUDRATE:
+            if len(value) == 4 and number and writer:
+                bridge.configure_uart(baudrate=number)
+            return uart.get('baudrate', 115200).to_bytes(4, 'big')
+        elif command == SET_DATASIZE:
+            if number in DATASIZES and writer:
+                bridge.configure_uart(bits=number)
+            return bytes((uart.get('bits', 8),))
+        elif command == SET_PARITY:
+            if number in PARITIES and writer:
+                bridge.configure_uart(parity=PARITIES[number])
+            return bytes((code(PARITIES, uart.get('parity')),))
+        elif command == SET_STOPSIZE:
+            if number in STOPSIZES and writer:
+                bridge.configure_uart(stop=STOPSIZES[number])
+            return bytes((code(STOPSIZES, uart.get('stop', 1)),))
+        elif command == SET_CONTROL:
+            return bytes((self.control(number, writer),))
+        elif command == NOTIFY_MODEMSTATE:
+            return MODEM_STATE
+        elif command == NOTIFY_LINESTATE:
+            return b'\x00'
+        elif command in (SET_LINESTATE_MASK, SET_MODEMSTATE_MASK):
+            return value
+        elif command == PURGE_DATA:
+            # 1 or 3: UART data not sent to this client yet
+            if number & 1:
+                client.queue.commit(len(client.queue))
+            return value
+        # FLOWCONTROL-SUSPEND/RESUME and unknown commands: no answer
+        return None
+
+    def control(self, number, writer):
+        bridge = self.bridge
+        if number in (FLOW_NONE, INFLOW_NONE) and writer:
+            bridge.configure_uart(flow=0)
+        elif number in (FLOW_HARDWARE, INFLOW_HARDWARE) and writer \
+                and HARDWARE_FLOW:
+            bridge.configure_uart(flow=HARDWARE_FLOW)
+        elif number == BREAK_ON:
+            if writer:
+                bridge.uart.sendbreak()
+            return number
+        elif number == BREAK_OFF or number == BREAK_REQUEST:
+            return BREAK_OFF
+        elif number in (DTR_REQUEST, RTS_REQUEST):
+            # lines without a pin (see "lines") are reported on
+            on = bridge.line_on('dtr' if number == DTR_REQUEST else 'rts')
+            return number + 1 if on is not False else number + 2
+        elif number in (DTR_ON, DTR_ON + 1, RTS_ON, RTS_ON + 1):
+            if writer:
+                bridge.set_line('dtr' if number < RTS_REQUEST else 'rts',
+                                number in (DTR_ON, RTS_ON))
+            return number
+        flow = bridge.config['uart'].get('flow', 0)
+        if number >= INFLOW_REQUEST:
+            return INFLOW_HARDWARE if flow else INFLOW_NONE
+        return FLOW_HARDWARE if flow else FLOW_NONE
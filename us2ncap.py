@@ -0,0 +1,269 @@
+# us2ncap.py
+#
+# Traffic capture for us2n bridges and s2n ports: enable it per bridge with
+# "capture": {"file": "/capture.bin"} in us2n.json. Records are batched in
+# RAM and written to the file in large blocks, files are rotated by size.
+# On a PC, decode captures to text or pcap with:
+#
+#   $ python us2ncap.py capture.bin.1 capture.bin [--pcap capture.pcap]
+
+import os
+import time
+import struct
+
+MAGIC = b'us2ncap1'
+# record: ms since the last TIME record, kind, data length, then the data
+HEADER = '<IBH'
+HEADER_SIZE = 7
+# MAGIC and the first TIME record
+FILE_HEADER_SIZE = len(MAGIC) + HEADER_SIZE + 8
+# serial->tcp data, tcp->serial data, time base: (seconds, ms) since 1970
+SERIAL, TCP, TIME = 0, 1, 2
+NAMES = {SERIAL: 'serial->tcp', TCP: 'tcp->serial'}
+# longer data is split (a record must fit in a pcap IPv4 packet)
+MAX_RECORD = 0xffff - 40
+# ms between TIME records, well within ticks_diff() range
+REBASE = 3600 * 1000
+
+# seconds from 1970 to the epoch of time.time()
+EPOCH_OFFSET = 946684800 if time.gmtime(0)[0] == 2000 else 0
+
+try:
+    ticks_ms, ticks_diff = time.ticks_ms, time.ticks_diff
+except AttributeError:
+    # CPython
+    def ticks_ms():
+        return int(time.monotonic() * 1000)
+
+    def ticks_diff(a, b):
+        return a - b
+
+
+def unix_time():
+    """(seconds, ms) since 1970"""
+    if hasattr(time, 'time_ns'):
+        ms = time.time_ns() // 1000000
+        return ms // 1000 + EPOCH_OFFSET, ms % 1000
+    return int(time.time()) + EPOCH_OFFSET, 0
+
+
+class Capture:
+    """Writes the traffic of a bridge to *file*, in blocks of *buffer*
+    bytes (or after *flush* ms). Past *size* bytes, the file is renamed
+    *file*.1 (and so on, *files* files are kept) and a new one started.
+
+    Counters go to *stats* (a bridge or port stats dict)"""
+
+    def __init__(self, file, size=64*1024, files=2, buffer=4096,
+                 flush=10000, stats=None):
+        self.file = file
+        self.size = size
+        self.files = files
+        self.flush_ms = flush
+        self.buffer = bytearray(buffer)
+        self.view = memoryview(self.buffer)
+        self.used = 0
+        # ticks_ms() of the oldest record in the buffer
+        self.first = None
+        self.f = None
+        self.written = 0
+        self.stats = {} if stats is None else stats
+        self.stats.update(capture_bytes=0, capture_records=0,
+                          capture_writes=0, capture_files=0,
+                          capture_errors=0)
+        self.base = ticks_ms()
+        self.base_time = struct.pack('<II', *unix_time())
+        # a previous capture becomes file.1
+        self.new_file()
+
+    def new_file(self):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+        names = [self.file] + ['{0}.{1}'.format(self.file, i)
+                               for i in range(1, self.files)]
+        for i in range(len(names) - 1, 0, -1):
+            try:
+                os.remove(names[i])
+            except OSError:
+                pass
+            try:
+                os.rename(names[i - 1], names[i])
+            except OSError:
+                pass
+        f = open(self.file, 'wb')
+        # records still buffered count from the current time base
+        header = MAGIC + struct.pack(HEADER, 0, TIME, 8) + self.base_time
+        f.write(header)
+        self.f = f
+        self.written = len(header)
+        self.stats['capture_files'] += 1
+
+    def from_serial(self, data):
+        self.write(SERIAL, data)
+
+    def to_serial(self, data):
+        self.write(TCP, data)
+
+    def write(self, kind, data):
+        now = ticks_ms()
+        if len(data) <= MAX_RECORD:
+            self.record(kind, now, data)
+            return
+        data = memoryview(data)
+        for start in range(0, len(data), MAX_RECORD):
+            self.record(kind, now, data[start:start + MAX_RECORD])
+
+    def record(self, kind, now, data):
+        n = len(data)
+        if self.used + HEADER_SIZE + n > len(self.buffer):
+            self.flush()
+        offset = ticks_diff(now, self.base)
+        if HEADER_SIZE + n > len(self.buffer):
+            # too big to be batched
+            self.output(struct.pack(HEADER, offset, kind, n), data)
+        else:
+            if not self.used:
+                self.first = now
+            used = self.used
+            struct.pack_into(HEADER, self.buffer, used, offset, kind, n)
+            used += HEADER_SIZE
+            self.view[used:used + n] = data
+            self.used = used + n
+        self.stats['capture_records'] += 1
+
+    def flush(self):
+        if self.used:
+            self.output(self.view[:self.used])
+            self.used = 0
+
+    def output(self, *blocks):
+        n = 0
+        for block in blocks:
+            n += len(block)
+        stats = self.stats
+        try:
+            if self.f is None or (self.written + n > self.size and
+                                  self.written > FILE_HEADER_SIZE):
+                self.new_file()
+            for block in blocks:
+                self.f.write(block)
+            self.f.flush()
+            self.written += n
+            stats['capture_writes'] += 1
+            stats['capture_bytes'] += n
+        except OSError:
+            # ex: file system full. The data is lost, retried with a
+            # new file next time
+            stats['capture_errors'] += 1
+            self.f = None
+
+    def tick(self):
+        """Write out old records, renew the time base"""
+        now = ticks_ms()
+        if self.used and ticks_diff(now, self.first) >= self.flush_ms:
+            self.flush()
+        if ticks_diff(now, self.base) >= REBASE:
+            # the records buffered count from the previous base
+            self.flush()
+            self.base = now
+            self.base_time = struct.pack('<II', *unix_time())
+            self.record(TIME, now, self.base_time)
+
+    def close(self):
+        self.flush()
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+
+
+def records(f):
+    """(unix time, kind, data) of the records of a capture file. A
+    truncated last record (ex: power loss) is ignored"""
+    if f.read(len(MAGIC)) != MAGIC:
+        raise ValueError('not a us2n capture')
+    base = 0
+    while True:
+        header = f.read(HEADER_SIZE)
+        if len(header) < HEADER_SIZE:
+            return
+        offset, kind, n = struct.unpack(HEADER, header)
+        data = f.read(n)
+        if len(data) < n:
+            return
+        if kind == TIME:
+            seconds, ms = struct.unpack('<II', data)
+            base = seconds + ms / 1000
+        else:
+            yield base + offset / 1000, kind, data
+
+
+def text(records, out):
+    for t, kind, data in records:
+        out.write('{0}.{1:03d} {2} {3} {4!r}\n'.format(
+            time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(t)),
+            int(t * 1000) % 1000, NAMES.get(kind, kind), len(data), data))
+
+
+# pcap: each record is a TCP segment between the serial side and the
+# network side, so that tools can follow the streams
+PCAP_ADDRESSES = {SERIAL: (b'\x0a\x00\x00\x01', 1),
+                  TCP: (b'\x0a\x00\x00\x02', 2)}
+
+
+def ip_checksum(header):
+    total = 0
+    for i in range(0, len(header), 2):
+        total += (header[i] << 8) + header[i + 1]
+    while total >> 16:
+        total = (total & 0xffff) + (total >> 16)
+    return ~total & 0xffff
+
+
+def pcap(records, out):
+    # LINKTYPE_RAW: IPv4 packets
+    out.write(struct.pack('<IHHiIII', 0xa1b2c3d4, 2, 4, 0, 0, 65535, 101))
+    seq = {SERIAL: 1, TCP: 1}
+    for t, kind, data in records:
+        if kind not in PCAP_ADDRESSES:
+            continue
+        other = TCP if kind == SERIAL else SERIAL
+        (src, sport), (dst, dport) = PCAP_ADDRESSES[kind], PCAP_ADDRESSES[other]
+        ip = bytearray(struct.pack('!BBHHHBBH4s4s', 0x45, 0, 40 + len(data),
+                                   0, 0x4000, 64, 6, 0, src, dst))
+        ip[10:12] = struct.pack('!H', ip_checksum(ip))
+        tcp = struct.pack('!HHIIBBHHH', sport, dport, seq[kind], seq[other],
+                          0x50, 0x18, 65535, 0, 0)
+        seq[kind] = (seq[kind] + len(data)) & 0xffffffff
+        packet = bytes(ip) + tcp + data
+        out.write(struct.pack('<IIII', int(t), int(t % 1 * 1000000),
+                              len(packet), len(packet)) + packet)
+
+
+def main():
+    import sys
+    import argparse
+    parser = argparse.ArgumentParser(description='decode us2n captures')
+    parser.add_argument('files', nargs='+',
+                        help='capture files, oldest first '
+                             '(ex: capture.bin.1 capture.bin)')
+    parser.add_argument('--pcap', default=None,
+                        help='write a pcap file instead of text (serial '
+                             'side 10.0.0.1:1, network side 10.0.0.2:2)')
+    args = parser.parse_args()
+
+    def all_records():
+        for name in args.files:
+            with open(name, 'rb') as f:
+                for record in records(f):
+                    yield record
+
+    if args.pcap is None:
+        text(all_records(), sys.stdout)
+    else:
+        with open(args.pcap, 'wb') as out:
+            pcap(all_records(), out)
+
+
+if __name__ == '__main__':
+    main()
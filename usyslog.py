@@ -1,9 +1,11 @@
 """
 This syslog client can send UDP packets to a remote syslog server.
 
-Timestamps are not supported for simplicity.
+UDPClient sends RFC 3164 messages without timestamps, for simplicity.
+Logger is long lived: it queues RFC 5424 messages, rate limited, which are
+sent over UDP or TCP from the main loop with drain().
 
-For more information, see RFC 3164.
+For more information, see RFC 3164, RFC 5424 and RFC 6587.
 
 The MIT License (MIT)
 
@@ -27,7 +29,33 @@ LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
 OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
-import usocket
+import time
+import errno
+import select
+
+try:
+    import usocket as socket
+except ImportError:
+    import socket
+
+try:
+    from micropython import const
+except ImportError:
+    def const(value):
+        return value
+
+try:
+    ticks_ms, ticks_diff = time.ticks_ms, time.ticks_diff
+except AttributeError:
+    # CPython
+    def ticks_ms():
+        return int(time.monotonic() * 1000)
+
+    def ticks_diff(a, b):
+        return a - b
+
+# errors meaning "try again later" on a non-blocking socket
+WOULDBLOCK = (errno.EAGAIN, getattr(errno, 'EWOULDBLOCK', errno.EAGAIN))
 
 # Facility constants
 F_KERN = const(0)
@@ -95,8 +123,8 @@ class SyslogClient:
 
 class UDPClient(SyslogClient):
     def __init__(self, ip='127.0.0.1', port=514, facility=F_USER):
-        self._addr = usocket.getaddrinfo(ip, port)[0][4]
-        self._sock = usocket.socket(usocket.AF_INET, usocket.SOCK_DGRAM)
+        self._addr = socket.getaddrinfo(ip, port)[0][4]
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         super().__init__(facility)
 
     def log(self, severity, msg):
@@ -106,3 +134,138 @@ class UDPClient(SyslogClient):
     def close(self):
         self._sock.close()
 
+
+class Logger(SyslogClient):
+    """Long lived RFC 5424 client. log() only queues messages (up to
+    *queue* of them), drain() sends them without blocking: call it from
+    the main loop. Past *rate* messages per second (in bursts of up to
+    *burst*), messages are dropped and their number is reported with the
+    next one. *transport* is 'udp' or 'tcp' (octet counting framing).
+    Messages wait for resolve() (blocking unless given a numeric
+    address), connections are retried every *retry* ms"""
+
+    def __init__(self, ip='127.0.0.1', port=514, facility=F_USER,
+                 transport='udp', hostname='-', app='us2n', rate=10,
+                 burst=20, queue=32, retry=10000):
+        super().__init__(facility)
+        self.host, self.port = ip, port
+        self.tcp = transport == 'tcp'
+        # HOSTNAME APP-NAME PROCID MSGID STRUCTURED-DATA
+        self.header = ' {0} {1} - - - '.format(
+            hostname.replace(' ', '-') or '-', app)
+        self.rate, self.burst = rate, burst
+        self.tokens = burst
+        self.last = ticks_ms()
+        self.queue = []
+        self.max_queue = queue
+        self.retry = retry
+        self.address = None
+        self.sock = None
+        # poll object while a TCP connection is in progress
+        self.connecting = None
+        # rest of a message partly sent over TCP
+        self.pending = None
+        # ticks_ms() of the last failure
+        self.failed = None
+        self.suppressed = 0
+        self.sent = 0
+        self.dropped = 0
+
+    def allow(self):
+        now = ticks_ms()
+        self.tokens = min(self.burst, self.tokens +
+                          ticks_diff(now, self.last) * self.rate / 1000)
+        self.last = now
+        if self.tokens < 1 or len(self.queue) >= self.max_queue:
+            self.suppressed += 1
+            self.dropped += 1
+            return False
+        self.tokens -= 1
+        return True
+
+    def log(self, severity, *args):
+        # args are formatted only if the message is not dropped
+        if not self.allow():
+            return
+        if self.suppressed:
+            self.queue.append(self.format(S_WARN, '{0} messages suppressed'
+                                          .format(self.suppressed)))
+            self.suppressed = 0
+        self.queue.append(self.format(severity,
+                                      ' '.join(str(arg) for arg in args)))
+
+    def info(self, *args):
+        self.log(S_INFO, *args)
+
+    def format(self, severity, msg):
+        tm = time.gmtime()
+        # no timestamp before the clock is set
+        stamp = '-' if tm[0] < 2021 else \
+            '{0:04d}-{1:02d}-{2:02d}T{3:02d}:{4:02d}:{5:02d}Z'.format(*tm)
+        data = '<{0}>1 {1}{2}{3}'.format(severity + (self._facility << 3),
+                                         stamp, self.header, msg).encode()
+        if self.tcp:
+            data = '{0} '.format(len(data)).encode() + data
+        return data
+
+    def resolve(self, host=None):
+        self.address = socket.getaddrinfo(host or self.host, self.port)[0][-1]
+
+    def open(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM if self.tcp
+                             else socket.SOCK_DGRAM)
+        self.sock = sock
+        sock.setblocking(False)
+        if self.tcp:
+            try:
+                sock.connect(self.address)
+            except OSError as e:
+                if e.args[0] != errno.EINPROGRESS and \
+                   e.args[0] not in WOULDBLOCK:
+                    raise
+            self.connecting = select.poll()
+            self.connecting.register(sock, select.POLLOUT)
+
+    def drain(self):
+        """Send the queued messages until the socket would block"""
+        if self.address is None or (not self.queue and self.pending is None):
+            return
+        if self.failed is not None:
+            if ticks_diff(ticks_ms(), self.failed) < self.retry:
+                return
+            self.failed = None
+        try:
+            if self.sock is None:
+                self.open()
+            if self.connecting is not None:
+                events = self.connecting.poll(0)
+                if not events:
+                    return
+                if events[0][1] & (select.POLLERR | select.POLLHUP):
+                    raise OSError(errno.ECONNREFUSED)
+                self.connecting = None
+            while self.pending is not None or self.queue:
+                if self.pending is None:
+                    self.pending = memoryview(self.queue.pop(0))
+                if self.tcp:
+                    n = self.sock.send(self.pending)
+                else:
+                    n = self.sock.sendto(self.pending, self.address)
+                if n < len(self.pending):
+                    self.pending = self.pending[n:]
+                else:
+                    self.pending = None
+                    self.sent += 1
+        except OSError as e:
+            if e.args[0] in WOULDBLOCK:
+                return
+            # the message being sent is lost, the queue is kept
+            self.close()
+            self.failed = ticks_ms()
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+        self.connecting = None
+        self.pending = None